@@ -0,0 +1,80 @@
+"""
+Admin HTTP endpoint for operators, listening on loopback interface only
+
+* `GET /metrics` - metrics as JSON
+* `GET /metrics?format=prometheus` - metrics in Prometheus text format
+* `GET /profile` - profiler state and summary of the last profile
+* `POST /profile?mode=sample&seconds=30` - starts profiling window (see profiler.py), `POST /profile?stop=1` stops it.
+  Requires `X-Admin-Token` header matching ADMIN_TOKEN setting, refused while it isn't set
+"""
+from hmac import compare_digest
+
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+import metrics
+import settings
+from encoding import encode
+from profiler import PROFILES, profiler
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        if request.args.get(b'format', [None])[0] == b'prometheus':
+            request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+            return metrics.registry.prometheus()
+        request.setHeader(b'Content-Type', b'application/json')
+        return encode(metrics.registry.snapshot())
+
+
+class ProfileResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'application/json')
+        return encode(profiler.status())
+
+    def render_POST(self, request):
+        request.setHeader(b'Content-Type', b'application/json')
+        if not settings.ADMIN_TOKEN:
+            request.setResponseCode(403)
+            return encode({'error': 'profiling from admin endpoint is disabled, set ADMIN_TOKEN to enable it'})
+        if not compare_digest(request.getHeader(b'X-Admin-Token') or b'', settings.ADMIN_TOKEN):
+            request.setResponseCode(403)
+            return encode({'error': 'X-Admin-Token header is missing or wrong'})
+        if request.args.get(b'stop'):
+            return encode({'stopped': profiler.stop()})
+        mode = request.args.get(b'mode', [b'sample'])[0]
+        try:
+            seconds = float(request.args.get(b'seconds', [settings.PROFILE_SECONDS])[0])
+        except ValueError:
+            seconds = None
+        if mode not in PROFILES or not seconds or seconds <= 0:
+            request.setResponseCode(400)
+            return encode({'error': 'mode should be one of %s, seconds positive number' % ', '.join(PROFILES)})
+        path = profiler.start(mode, seconds)
+        if not path:
+            request.setResponseCode(409)
+            return encode({'error': 'profiling is already active', 'file': profiler.status()['file']})
+        return encode({'started': mode, 'seconds': seconds, 'file': path})
+
+
+def start(port):
+    """
+    :param port: 0 doesn't start endpoint
+    :return: listening port
+    """
+    if not port:
+        return None
+    root = Resource()
+    root.putChild(b'metrics', MetricsResource())
+    root.putChild(b'profile', ProfileResource())
+    site = Site(root)
+    site.noisy = False
+    listening = reactor.listenTCP(port, site, interface='127.0.0.1')
+    log.msg('Admin endpoint on 127.0.0.1:%s' % port)
+    return listening
@@ -0,0 +1,148 @@
+"""
+AI search processes. Each one is this script talking AMP over its stdin/stdout, so it exits as soon as server
+closes the pipes or dies. Engines and their transposition tables stay warm in the process between searches
+"""
+import os
+import sys
+
+from twisted.internet import defer, reactor, stdio
+from twisted.internet.endpoints import ProcessEndpoint
+from twisted.internet.protocol import Factory
+from twisted.protocols import amp
+from twisted.python import log
+
+import settings
+from game import GameAI
+
+RESPAWN_DELAY = 1
+
+
+class Search(amp.Command):
+    arguments = [('size', amp.Integer()), ('win_length', amp.Integer()), ('own', amp.Integer()),
+                 ('other', amp.Integer()), ('depth', amp.Integer()), ('time_limit', amp.Float())]
+    response = [('x', amp.Integer()), ('y', amp.Integer())]
+
+
+class SearchServer(amp.AMP):
+    """
+    Search process side
+    """
+    @Search.responder
+    def search(self, size, win_length, own, other, depth, time_limit):
+        x, y = GameAI.engine(size, win_length).best_move(own, other, depth, time_limit)
+        return {'x': x, 'y': y}
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        reactor.stop()
+
+
+class SearchProcess(amp.AMP):
+    """
+    Server side of search process, connected to its stdin and stdout
+    """
+    def __init__(self, pool):
+        amp.AMP.__init__(self)
+        self.pool = pool
+        self.searches = 0
+
+    def makeConnection(self, transport):
+        """process transport has no addresses AMP logs connection with"""
+        self._transportPeer = self._transportHost = 'AI process'
+        amp.BinaryBoxProtocol.makeConnection(self, transport)
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.pool.process_ended(self, reason)
+
+
+class AIPool(object):
+    """
+    Processes computing AI moves away from reactor thread
+    """
+
+    def __init__(self, processes):
+        self.__processes = []
+        self.__stopping = False
+        for _ in range(processes):
+            self.spawn()
+
+    def spawn(self):
+        if self.__stopping:
+            return
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        endpoint = ProcessEndpoint(reactor, sys.executable, [sys.executable, script], env=os.environ)
+        endpoint.connect(Factory.forProtocol(lambda: SearchProcess(self))).addCallbacks(
+            self.__processes.append, log.err)
+
+    def process_ended(self, process, reason):
+        """replaces process which died unless pool is being closed, its searches fail with connection
+
+        :param process:
+        :param reason:
+        :return:
+        """
+        if process in self.__processes:
+            self.__processes.remove(process)
+        if not self.__stopping:
+            log.msg('AI process exited: %s' % reason.value)
+            reactor.callLater(RESPAWN_DELAY, self.spawn)
+
+    def best_move(self, size, win_length, own, other, depth, time_limit):
+        """Starts search in the least busy process. Search itself can't be interrupted, but it stops at time limit,
+        cancelled deferred just won't fire with its result
+
+        :return: deferred fired with (x, y)
+        :rtype: defer.Deferred
+        """
+        result = defer.Deferred()
+        if not self.__processes:
+            result.errback(RuntimeError('No AI processes running'))
+            return result
+        process = min(self.__processes, key=lambda candidate: candidate.searches)
+        process.searches += 1
+
+        def found(response):
+            process.searches -= 1
+            if not result.called:
+                result.callback((response['x'], response['y']))
+
+        def failed(failure):
+            process.searches -= 1
+            if not result.called:
+                result.errback(failure)
+        search = process.callRemote(Search, size=size, win_length=win_length, own=own, other=other, depth=depth,
+                                    time_limit=time_limit)
+        search.addCallbacks(found, failed)
+        return result
+
+    def close(self):
+        """closes pipes of all processes, they exit once current search is done
+
+        :return:
+        """
+        self.__stopping = True
+        for process in self.__processes:
+            process.transport.loseConnection()
+
+
+ai_pool = None
+
+
+def start(processes=settings.AI_PROCESSES):
+    """creates module-wide pool, processes are started once and reused for all games
+
+    :param processes: no pool is created for 0, AI then searches in reactor thread
+    :return:
+    """
+    global ai_pool
+    if processes > 0:
+        ai_pool = AIPool(processes)
+        reactor.addSystemEventTrigger('before', 'shutdown', ai_pool.close)
+        log.msg('Started %s AI processes' % processes)
+    return ai_pool
+
+
+if __name__ == '__main__':
+    stdio.StandardIO(SearchServer())
+    reactor.run()
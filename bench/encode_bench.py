@@ -0,0 +1,80 @@
+"""
+Encoding cost of one game update: full state built and encoded for every recipient (as before encoding cache)
+against shared state encoded once with your_type spliced in, and against delta encoded once
+
+Run from repository root: `python bench/encode_bench.py --size 15 --recipients 2`
+"""
+import os
+import sys
+from argparse import ArgumentParser
+from json import dumps
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+from encoding import SharedState, encode
+from main import GameSession
+from game import Game
+from user import User
+
+
+def make_session(size):
+    """session with half of the board filled
+
+    :param size:
+    :return:
+    """
+    game = Game(size, min(size, 5))
+    session = GameSession(1, game, User('cross'), User('circle'), (size, game.win_length))
+    signs = [settings.CROSS, settings.CIRCLE]
+    cells = [(x, y) for y in range(size) for x in range(size)]
+    for number, (x, y) in enumerate(cells[:len(cells) // 2]):
+        if game.state != Game.GAME:
+            break
+        game.make_move(signs[number % 2], x, y)
+    return session
+
+
+def full_state_per_recipient(session, recipients):
+    state = session.game_state
+    for number in range(recipients):
+        state['your_type'] = settings.CROSS if number % 2 == 0 else settings.CIRCLE
+        dumps(state).encode()
+
+
+def shared_state(session, shared, recipients):
+    delta = session.delta([0, 0], settings.CROSS)
+    shared.apply(delta)
+    for number in range(recipients):
+        shared.encoded(settings.CROSS if number % 2 == 0 else settings.CIRCLE)
+
+
+def delta_once(session, recipients):
+    encode(session.delta([0, 0], settings.CROSS))
+
+
+def measure(function, repeat, *args):
+    started = default_timer()
+    for _ in range(repeat):
+        function(*args)
+    return (default_timer() - started) / repeat * 1e6
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Game update encoding benchmark')
+    parser.add_argument('--size', type=int, default=15)
+    parser.add_argument('--recipients', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    session = make_session(args.size)
+    shared = SharedState(session.game_state)
+    results = [
+        ('full state per recipient', measure(full_state_per_recipient, args.repeat, session, args.recipients)),
+        ('shared state, spliced', measure(shared_state, args.repeat, session, shared, args.recipients)),
+        ('delta, encoded once', measure(delta_once, args.repeat, session, args.recipients)),
+    ]
+    print('%sx%s board, %s recipients, usec per update' % (args.size, args.size, args.recipients))
+    for name, usec in results:
+        print('%-26s %10.1f' % (name, usec))
@@ -0,0 +1,78 @@
+"""
+Memory footprint of registered users and live games: resident memory grown per object while all of them are
+kept alive, and size of pickled user record. Reads /proc, so it runs on Linux only
+
+Run from repository root: `python bench/memory_bench.py --users 200000 --games 20000`
+"""
+import gc
+import os
+import sys
+import uuid
+from argparse import ArgumentParser
+from pickle import HIGHEST_PROTOCOL, dumps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+from game import Game
+from user import User
+
+PAGE = os.sysconf('SC_PAGE_SIZE')
+SIGNS = (settings.CROSS, settings.CIRCLE)
+# board size, win length, moves played
+GAMES = ((3, 3, 4), (15, 5, 40))
+
+
+def resident():
+    """
+    :return: resident memory of the process, bytes
+    """
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * PAGE
+
+
+def per_object(make, count):
+    """
+    :param make: callable making object by its number
+    :param count:
+    :return: resident memory grown per object
+    """
+    objects = [None] * count
+    gc.collect()
+    before = resident()
+    for number in range(count):
+        objects[number] = make(number)
+    return (resident() - before) / float(count)
+
+
+def make_user(number):
+    """user who played some games"""
+    user = User(uuid.uuid1().hex)
+    user.wins, user.loses, user.ties = number % 40, number % 30, number % 5
+    user.rating = settings.RATING_START + number % 400 - 200.5
+    return user
+
+
+def make_game(size, win_length, moves):
+    cells = [(x, y) for y in range(size) for x in range(size)][:moves]
+
+    def make(number):
+        game = Game(size, win_length)
+        for move, (x, y) in enumerate(cells):
+            game.make_move(SIGNS[move % 2], x, y)
+        return game
+    return make
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Memory per user and per game')
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--games', type=int, default=20000)
+    args = parser.parse_args()
+
+    print('%-22s %8s %12s' % ('object', 'count', 'bytes/obj'))
+    print('%-22s %8s %12.1f' % ('User', args.users, per_object(make_user, args.users)))
+    for size, win_length, moves in GAMES:
+        name = 'Game %sx%s, %s moves' % (size, size, moves)
+        print('%-22s %8s %12.1f' % (name, args.games, per_object(make_game(size, win_length, moves), args.games)))
+    print('pickled User record: %s bytes' % len(dumps((make_user(1).user_id, make_user(1)), HIGHEST_PROTOCOL)))
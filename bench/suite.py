@@ -0,0 +1,348 @@
+"""
+Microbenchmarks of game and server hot paths. No network is used: server protocols are connected to transports
+which drop everything written.
+
+For every case it reports time per operation (best of --repeat runs) and container objects per operation left
+alive while results are kept (gc is disabled for that run), and compares both with baseline. Cases slower than
+baseline by more than --threshold, or allocating more, are flagged and the script exits with 1
+
+Run from repository root: `python bench/suite.py`, `python bench/suite.py --save` updates bench/baseline.json with cases which were run
+"""
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+from argparse import ArgumentParser
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer, task
+from twisted.test.proto_helpers import StringTransport
+
+import main
+import metrics
+import settings
+import user
+from encode_bench import make_session
+from game import O, X, Field, Game, Rules
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+BOARD = 15
+WIN_LENGTH = 5
+# whole row is needed to win, so alternating moves fill most of the board before diagonal is complete
+LONG_GAME = (19, 19)
+SIGNS = (settings.CROSS, settings.CIRCLE)
+SIGN_CODES = (X, O)
+USERS = (10000, 100000, 1000000)
+
+
+class NullTransport(StringTransport):
+    def write(self, data):
+        pass
+
+
+def cells(size):
+    return [(x, y) for y in range(size) for x in range(size)]
+
+
+def half_field():
+    field = Field(BOARD)
+    filled = cells(BOARD)[:BOARD * BOARD // 2]
+    for number, (x, y) in enumerate(filled):
+        field.put_sign(SIGN_CODES[number % 2], x, y)
+    return field, filled[-1]
+
+
+def field_put_sign():
+    moves = cells(BOARD)
+
+    def run():
+        field = Field(BOARD)
+        for number, (x, y) in enumerate(moves):
+            field.put_sign(SIGN_CODES[number % 2], x, y)
+        return field
+    return run, len(moves)
+
+
+def field_field():
+    field, _ = half_field()
+    return lambda: field.field, 1
+
+
+def rules_check_win_from_move():
+    field, (x, y) = half_field()
+    rules = Rules(WIN_LENGTH)
+    return lambda: rules.check_win_from_move(field, x, y), 1
+
+
+def game_moves(variant):
+    """
+    :return: moves filling the board row by row until game ends
+    """
+    game = Game(*variant)
+    moves = []
+    for number, (x, y) in enumerate(cells(variant[0])):
+        game.make_move(SIGNS[number % 2], x, y)
+        moves.append((x, y))
+        if game.state != Game.GAME:
+            break
+    return moves
+
+
+def game_make_move():
+    moves = game_moves(LONG_GAME)
+
+    def run():
+        game = Game(*LONG_GAME)
+        for number, (x, y) in enumerate(moves):
+            game.make_move(SIGNS[number % 2], x, y)
+        return game
+    return run, len(moves)
+
+
+def session_game_state():
+    session = make_session(BOARD)
+    return lambda: session.game_state, 1
+
+
+def connect(delta):
+    """registers new user through server protocol
+
+    :param delta: game updates as deltas
+    :return: protocol
+    :rtype: main.TTTServer
+    """
+    proto = main.TTTServer()
+    proto.makeConnection(NullTransport())
+    proto.dataReceived(json.dumps({'cmd': 'reg', 'delta': delta}) + '\r\n')
+    return proto
+
+
+def play(cross, circle, variant):
+    """queues both players, they are paired with each other as their ratings are reset
+
+    :return: game session
+    :rtype: main.GameSession
+    """
+    size, win_length = variant
+    for proto in (cross, circle):
+        proto.user.rating = settings.RATING_START
+        proto.dataReceived(json.dumps({'cmd': 'queue', 'size': size, 'win': win_length}) + '\r\n')
+    return main.game_manager.get_session(cross.user.user_id)
+
+
+def broadcast_update(delta):
+    def setup():
+        session = play(connect(delta), connect(delta), (BOARD, WIN_LENGTH))
+        return lambda: main.game_manager.broadcast_update(session, session.delta([0, 0], settings.CROSS)), 1
+    return setup
+
+
+def line_received(collect_metrics, delta=True):
+    """whole game of moves sent by both players, from raw data to updates written to transports
+
+    :param collect_metrics: measures instrumentation cost when compared with disabled metrics
+    :param delta: players get deltas, otherwise whole state after every move
+    """
+    def setup():
+        cross, circle = connect(delta), connect(delta)
+        players = (cross, circle)
+        moves = [json.dumps({'cmd': 'move', 'pos': [x, y]}) + '\r\n' for x, y in game_moves(LONG_GAME)]
+
+        def run():
+            metrics.enabled = collect_metrics
+            try:
+                play(cross, circle, LONG_GAME)
+                for number, line in enumerate(moves):
+                    players[number % 2].dataReceived(line)
+            finally:
+                metrics.enabled = settings.METRICS
+        return run, len(moves)
+    return setup
+
+
+def histogram_observe():
+    histogram = metrics.Histogram()
+    return lambda: histogram.observe(0.000123), 1
+
+
+CASES = [
+    ('Field.put_sign', field_put_sign),
+    ('Field.field', field_field),
+    ('Rules.check_win_from_move', rules_check_win_from_move),
+    ('Game.make_move', game_make_move),
+    ('GameSession.game_state', session_game_state),
+    ('broadcast_update full', broadcast_update(False)),
+    ('broadcast_update delta', broadcast_update(True)),
+    ('TTTServer.lineReceived move', line_received(False)),
+    ('TTTServer.lineReceived move, metrics', line_received(True)),
+    ('TTTServer.lineReceived move, full state', line_received(False, False)),
+    ('Histogram.observe', histogram_observe),
+]
+
+
+def timing(run, ops, repeat, number):
+    """
+    :return: best time per operation, usec
+    """
+    best = None
+    for _ in range(repeat):
+        started = default_timer()
+        for _ in range(number):
+            run()
+        elapsed = default_timer() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / number / ops * 1e6
+
+
+def allocations(run, ops, number):
+    """
+    :return: container objects per operation which are still alive after it, with results kept
+    """
+    results = []
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for _ in range(number):
+            results.append(run())
+        after = gc.get_count()[0]
+    finally:
+        gc.enable()
+    return (after - before) / float(number * ops)
+
+
+def calibrate(run, ops, target=0.1):
+    """
+    :return: calls of run taking about target seconds
+    """
+    started = default_timer()
+    run()
+    elapsed = max(default_timer() - started, 1e-7)
+    return max(1, int(target / elapsed))
+
+
+@defer.inlineCallbacks
+def save_users(users):
+    """UserManager.save_users with every user changed, including compaction of store, then start of another
+    manager over the same store. Runs in its own directory, which is removed with stores afterwards
+
+    :param users:
+    :return: usec per saved user, usec of start
+    """
+    workdir = os.getcwd()
+    rundir = tempfile.mkdtemp(dir=workdir)
+    os.chdir(rundir)
+    managers = []
+    try:
+        manager = user.UserManager()
+        managers.append(manager)
+        manager.load_users()
+        for _ in range(users):
+            changed = user.User(uuid.uuid4().hex)
+            manager.users[changed.user_id] = changed
+            manager.save_user(changed)
+        started = default_timer()
+        yield manager.save_users()
+        saved = (default_timer() - started) / users * 1e6
+        manager = user.UserManager()
+        managers.append(manager)
+        started = default_timer()
+        manager.load_users()
+        defer.returnValue((saved, (default_timer() - started) * 1e6))
+    finally:
+        for manager in managers:
+            manager.close()
+        os.chdir(workdir)
+        shutil.rmtree(rundir, ignore_errors=True)
+
+
+@defer.inlineCallbacks
+def run_cases(args):
+    results = {}
+    for name, setup in CASES:
+        if args.only and args.only not in name:
+            continue
+        run, ops = setup()
+        number = calibrate(run, ops)
+        results[name] = {'usec': timing(run, ops, args.repeat, number), 'objects': allocations(run, ops, number)}
+        report(name, results[name], args.baseline.get(name), args.threshold)
+    for users in args.users:
+        names = ('UserManager.save_users %s' % users, 'UserManager.load_users %s' % users)
+        if args.only and not any(args.only in name for name in names):
+            continue
+        for name, usec in zip(names, (yield save_users(users))):
+            results[name] = {'usec': usec, 'objects': None}
+            report(name, results[name], args.baseline.get(name), args.threshold)
+    defer.returnValue(results)
+
+
+def regressed(result, baseline, threshold):
+    if baseline is None:
+        return False
+    if result['usec'] > baseline['usec'] * (1 + threshold):
+        return True
+    return result['objects'] is not None and result['objects'] > baseline['objects'] + 0.5
+
+
+def report(name, result, baseline, threshold):
+    objects = '-' if result['objects'] is None else '%.1f' % result['objects']
+    line = '%-42s %12.3f %9s' % (name, result['usec'], objects)
+    if baseline is not None:
+        change = (result['usec'] / baseline['usec'] - 1) * 100
+        line += ' %12.3f %+8.1f%%' % (baseline['usec'], change)
+        if regressed(result, baseline, threshold):
+            line += '  REGRESSION'
+    print(line)
+    sys.stdout.flush()
+
+
+def main_run(reactor, args):
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    # cases register users through connect(), their changes are written to store in this directory
+    user.user_mananger.load_users()
+    main.game_manager = main.GameManager()
+    print('%-42s %12s %9s %12s %9s' % ('case', 'usec/op', 'objs/op', 'baseline', 'change'))
+
+    def close(results):
+        """users registered by cases are written and store is closed before its directory is removed"""
+        saved = user.user_mananger.save_users()
+        saved.addCallback(lambda _: user.user_mananger.close())
+        return saved.addCallback(lambda _: results)
+
+    def done(results):
+        shutil.rmtree(workdir, ignore_errors=True)
+        if args.save:
+            args.baseline.update(results)
+            with open(BASELINE, 'w') as fp:
+                json.dump(args.baseline, fp, indent=2, sort_keys=True)
+            print('baseline saved to %s' % BASELINE)
+            return
+        failed = [name for name, result in results.items()
+                  if regressed(result, args.baseline.get(name), args.threshold)]
+        if failed:
+            print('%s regressions beyond %.0f%%' % (len(failed), args.threshold * 100))
+            raise SystemExit(1)
+    return run_cases(args).addCallback(close).addCallback(done)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Hot path microbenchmarks')
+    parser.add_argument('--repeat', type=int, default=7, help='timed runs per case, best one counts')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown against baseline')
+    parser.add_argument('--users', default=','.join(str(users) for users in USERS),
+                        help='comma separated user counts for save_users, empty to skip')
+    parser.add_argument('--only', help='run only cases with this in name')
+    parser.add_argument('--save', action='store_true', help='replace baseline of cases which were run')
+    args = parser.parse_args()
+    args.users = [int(users) for users in args.users.split(',') if users]
+    args.baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as fp:
+            args.baseline = json.load(fp)
+    task.react(main_run, [args])
@@ -1,12 +1,13 @@
 import curses
 import curses.wrapper
-from json import load, dump, loads, dumps
+from json import load, dump, dumps
 
 import os
 import sys
 from twisted.internet import reactor, task
 from twisted.internet.protocol import ClientFactory, connectionDone
-from twisted.protocols.basic import LineReceiver
+
+from protocol import TTTProtocol
 
 
 class TextTooLongError(Exception):
@@ -17,17 +18,11 @@ CREDENTIALS = 'creds.json'
 DEBUG = False
 
 
-class TTTClient(LineReceiver):
-    STATE_AUTH = 0
-    STATE_IDLE = 1
-    STATE_QUEUE = 2
-    STATE_GAME = 3
-
+class TTTClient(TTTProtocol):
     def __init__(self, screen):
-        self.state = self.STATE_AUTH
+        TTTProtocol.__init__(self)
         self.__screen = screen
         self.__screen.client = self
-        self.stats = None
         screen_task = task.LoopingCall(self.__screen.updateTerminal)
         screen_task.start(1.0)
 
@@ -43,9 +38,7 @@ class TTTClient(LineReceiver):
             self.__screen.addLine('Got input "%s", len: %s' % (command, len(command)))
         if self.state == self.STATE_IDLE:
             if command.upper() == 'Q':
-                net_cmd = {"cmd": "queue"}
-                self.state = self.STATE_QUEUE
-                self.send_data(net_cmd)
+                self.queue()
                 reactor.removeReader(sobj)
         elif self.state == self.STATE_GAME:
             try:
@@ -53,8 +46,7 @@ class TTTClient(LineReceiver):
             except ValueError as e:
                 cmd_pairs = []
             if len(cmd_pairs) == 2:
-                net_cmd = {"cmd": "move", "pos": cmd_pairs}
-                self.send_data(net_cmd)
+                self.move(*cmd_pairs)
                 reactor.removeReader(sobj)
             else:
                 self.__screen.addLine('Error! Input 2 numbers separated by whitespace')
@@ -63,94 +55,57 @@ class TTTClient(LineReceiver):
         self.__screen.set_status_disconnected()
         self.__screen.addLine('Connection lost! Restart client')
 
-    def connectionMade(self):
-        """tries to auth on connection
-
-        :return:
-        """
-        creds = self.get_credentials()
-        if not creds:
-            command = {'cmd': 'reg'}
-        else:
-            command = {'cmd': 'auth', 'user_id': creds.get('user_id')}
-        self.send_data(command)
-
     def lineReceived(self, line):
-        """parses data received and reacts on it
-
-        :param line:
-        :return:
-        """
         if DEBUG:
             self.__screen.addLine('>> %s' % line)
-        data = self.parse_packet(line)
-        command = data.get("cmd")
-        if self.state == self.STATE_AUTH:
-            if command == 'reg':
-                user_id = data.get('user_id')
-                if user_id:
-                    self.save_credentials(user_id)
-                self.state = self.STATE_IDLE
-                self.stats = [0, 0, 0]
-                self.__screen.addLine('Registered!')
-            elif command == 'auth':
-                self.state = self.STATE_IDLE
-                self.stats = data.get('stats')
-                self.__screen.addLine('Authorized!')
-            if self.state == self.STATE_IDLE:
-                self.idle_message()
-                self.__screen.set_status_idle(self.stats)
-        elif self.state == self.STATE_QUEUE:
-            if command == 'state':
-                self.state = self.STATE_GAME
-                field = data.get('field')
-                your_sign = data.get('your_type')
-                opponent_sign = "x"
-                if your_sign == "x":
-                    opponent_sign = "o"
-                opponent = data.get("player_%s" % opponent_sign)
-                you = data.get("player_%s" % your_sign)
-                is_human = (opponent['name'] != 'AI')
-                self.__screen.set_status_game(your_sign, opponent['stats'], is_human)
-                self.__screen.addLine(' ')
-                self.__screen.addLine('Games started')
-                self.draw_field(field)
-                self.should_i_move(data)
-        elif self.state == self.STATE_GAME:
-            if command == 'state':
-                finished = data.get('ended')
-                field = data.get('field')
-                self.draw_field(field)
-                if not finished:
-                    self.should_i_move(data)
-                else:
-                    self.__screen.addLine('Game ended!')
-                    your_sign = data.get('your_type')
-                    winner = data.get('winner')
-                    if winner is None:
-                        message = "It's a TIE!"
-                    elif winner == your_sign:
-                        message = "Congratulations! You've won!"
-                    else:
-                        message = 'You lose.'
-                    self.__screen.addLine(message)
-                    self.stats = data.get('player_%s' % your_sign).get('stats')
-                    self.state = self.STATE_IDLE
-                    self.idle_message()
-                    self.__screen.set_status_idle(self.stats)
-
-    def should_i_move(self, data):
-        """If client should display prompt to move
-
-        :param data:
-        :return:
-        """
-        if data.get('your_type') != data.get('last_turn'):
-            self.__screen.addLine("It's your turn now!")
-            self.__screen.addLine("Input number of row, then number of column (Like 'x y')")
-            reactor.addReader(sobj)
+        TTTProtocol.lineReceived(self, line)
+
+    def registered(self, user_id):
+        if user_id:
+            self.save_credentials(user_id)
+        self.__screen.addLine('Registered!')
+
+    def authorized(self, data):
+        self.__screen.addLine('Authorized!')
+
+    def idle(self):
+        self.idle_message()
+        self.__screen.set_status_idle(self.stats)
+
+    def game_started(self, state):
+        your_sign = state.get('your_type')
+        opponent_sign = "x"
+        if your_sign == "x":
+            opponent_sign = "o"
+        opponent = state.get("player_%s" % opponent_sign)
+        is_human = (opponent['name'] != 'AI')
+        self.__screen.set_status_game(your_sign, opponent['stats'], is_human)
+        self.__screen.addLine(' ')
+        self.__screen.addLine('Games started')
+        self.draw_field(state.get('field'))
+
+    def game_updated(self, state):
+        self.draw_field(state.get('field'))
+
+    def game_ended(self, state):
+        self.__screen.addLine('Game ended!')
+        your_sign = state.get('your_type')
+        winner = state.get('winner')
+        if winner is None:
+            message = "It's a TIE!"
+        elif winner == your_sign:
+            message = "Congratulations! You've won!"
         else:
-            self.__screen.addLine("Hidden movements... Other player is thinking.")
+            message = 'You lose.'
+        self.__screen.addLine(message)
+
+    def your_turn(self, state):
+        self.__screen.addLine("It's your turn now!")
+        self.__screen.addLine("Input number of row, then number of column (Like 'x y')")
+        reactor.addReader(sobj)
+
+    def their_turn(self, state):
+        self.__screen.addLine("Hidden movements... Other player is thinking.")
 
     def idle_message(self):
         """message that should be displayed when client enters idle state
@@ -191,14 +146,6 @@ class TTTClient(LineReceiver):
 
         self.__screen.drawField(new_field)
 
-    @staticmethod
-    def parse_packet(packet):
-        try:
-            data = loads(packet)
-        except Exception:
-            return False
-        return data
-
     def save_credentials(self, user_id):
         """saves game credentials on disk
 
@@ -221,16 +168,18 @@ class TTTClient(LineReceiver):
                     return creds
         return False
 
+    def credentials(self):
+        return (self.get_credentials() or {}).get('user_id')
+
     def send_data(self, data):
         """sends data to server
 
         :param data:
         :return:
         """
-        command = dumps(data)
         if DEBUG:
-            self.__screen.addLine('<< %s' % command)
-        self.sendLine(command)
+            self.__screen.addLine('<< %s' % dumps(data))
+        TTTProtocol.send_data(self, data)
 
 
 class CursesStdIO:
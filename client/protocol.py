@@ -0,0 +1,171 @@
+"""
+Client side of the game protocol without any UI. Subclasses react to protocol events by overriding hooks
+"""
+from json import dumps, loads
+
+from twisted.protocols.basic import LineReceiver
+
+
+class TTTProtocol(LineReceiver):
+    STATE_AUTH = 0
+    STATE_IDLE = 1
+    STATE_QUEUE = 2
+    STATE_GAME = 3
+
+    def __init__(self):
+        self.state = self.STATE_AUTH
+        self.stats = None
+        self.game_state = None
+
+    def connectionMade(self):
+        """tries to auth on connection
+
+        :return:
+        """
+        user_id = self.credentials()
+        if not user_id:
+            command = {'cmd': 'reg', 'delta': True}
+        else:
+            command = {'cmd': 'auth', 'user_id': user_id, 'delta': True}
+        self.send_data(command)
+
+    def lineReceived(self, line):
+        """parses data received and reacts on it
+
+        :param line:
+        :return:
+        """
+        data = self.parse_packet(line)
+        if not data:
+            return
+        command = data.get("cmd")
+        if command == 'ping':
+            return self.send_data({"cmd": "pong"})
+        if self.state == self.STATE_AUTH:
+            if command == 'reg':
+                self.state = self.STATE_IDLE
+                self.stats = [0, 0, 0]
+                self.registered(data.get('user_id'))
+            elif command == 'auth':
+                if not data.get('success'):
+                    return self.auth_failed()
+                self.state = self.STATE_IDLE
+                self.stats = data.get('stats')
+                self.authorized(data)
+            if self.state == self.STATE_IDLE:
+                self.idle()
+        elif self.state == self.STATE_QUEUE:
+            if command == 'state':
+                self.state = self.STATE_GAME
+                self.game_state = data
+                self.game_started(data)
+                self.check_turn(data)
+        elif self.state == self.STATE_GAME:
+            if command == 'move':
+                return self.move_done(data.get('success'))
+            if command == 'delta':
+                data = self.apply_delta(data)
+                if data is False:
+                    return
+                command = 'state'
+            if command == 'state':
+                self.game_state = data
+                self.game_updated(data)
+                if not data.get('ended'):
+                    self.check_turn(data)
+                else:
+                    self.stats = data.get('player_%s' % data.get('your_type')).get('stats')
+                    self.state = self.STATE_IDLE
+                    self.game_ended(data)
+                    self.idle()
+
+    def apply_delta(self, delta):
+        """applies server delta to the last known game state, asks for full state if some delta was missed
+
+        :param delta:
+        :return: updated state or False if it should be requested
+        """
+        state = self.game_state
+        if state is None or delta.get('seq') != state.get('seq', 0) + 1:
+            self.send_data({"cmd": "state"})
+            return False
+        move = delta.get('move')
+        if move is not None:
+            x, y = move
+            state['field'][y][x] = delta.get('sign')
+            state['last_turn'] = delta.get('sign')
+        for key in ('seq', 'ended', 'winner'):
+            state[key] = delta.get(key)
+        return state
+
+    def check_turn(self, data):
+        if data.get('your_type') != data.get('last_turn'):
+            self.your_turn(data)
+        else:
+            self.their_turn(data)
+
+    def queue(self, **options):
+        """enters gaming queue
+
+        :param options: size, win, level
+        :return:
+        """
+        command = {"cmd": "queue"}
+        command.update(options)
+        self.state = self.STATE_QUEUE
+        self.send_data(command)
+
+    def move(self, x, y):
+        self.send_data({"cmd": "move", "pos": [x, y]})
+
+    @staticmethod
+    def parse_packet(packet):
+        try:
+            data = loads(packet)
+        except Exception:
+            return False
+        return data
+
+    def send_data(self, data):
+        """sends data to server
+
+        :param data:
+        :return:
+        """
+        self.sendLine(dumps(data))
+
+    def credentials(self):
+        """
+        :return: user id to authorize with, or None to register new user
+        """
+        return None
+
+    def registered(self, user_id):
+        pass
+
+    def authorized(self, data):
+        pass
+
+    def auth_failed(self):
+        pass
+
+    def idle(self):
+        """authorized and not playing"""
+
+    def game_started(self, state):
+        pass
+
+    def game_updated(self, state):
+        pass
+
+    def game_ended(self, state):
+        pass
+
+    def your_turn(self, state):
+        pass
+
+    def their_turn(self, state):
+        pass
+
+    def move_done(self, success):
+        pass
@@ -0,0 +1,237 @@
+"""
+Headless load generator: swarm of bots speaking the same protocol as the client, each one registers, queues and
+plays random moves in a loop. Reports throughput and latency percentiles of auth, queue-to-start (queue command
+to game start) and move-to-update (move command to game update with it)
+
+Run from client directory: `python swarm.py --bots 2000 --rate 200 --duration 60`
+"""
+import random
+import resource
+from argparse import ArgumentParser
+from collections import deque
+
+from twisted.internet import reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
+
+from protocol import TTTProtocol
+
+SPAWN_INTERVAL = 0.1
+PERCENTILES = (50, 90, 99)
+
+
+class Latencies(object):
+    """
+    Latency samples by name
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    @staticmethod
+    def percentile(ordered, percent):
+        return ordered[int(round(percent / 100.0 * (len(ordered) - 1)))]
+
+    def report(self):
+        """
+        :return: line per name: count, percentiles and max in milliseconds
+        """
+        lines = []
+        for name in sorted(self.samples):
+            ordered = sorted(self.samples[name])
+            values = ['p%s %.1f' % (percent, self.percentile(ordered, percent) * 1000) for percent in PERCENTILES]
+            lines.append('  %-15s n=%-7s %s max %.1f ms' % (name, len(ordered), ', '.join(values),
+                                                               ordered[-1] * 1000))
+        return lines
+
+
+class Bot(TTTProtocol):
+    """
+    Player which plays random moves. After every game it leaves with churn probability, swarm connects it again
+    later with the same user id
+    """
+
+    def __init__(self, swarm, user_id=None):
+        TTTProtocol.__init__(self)
+        self.swarm = swarm
+        self.user_id = user_id
+        self.leaving = False
+        self.__connected_at = None
+        self.__queued_at = None
+        self.__moved_at = None
+
+    def credentials(self):
+        return self.user_id
+
+    def connectionMade(self):
+        self.__connected_at = reactor.seconds()
+        TTTProtocol.connectionMade(self)
+
+    def connectionLost(self, reason=None):
+        self.swarm.bot_lost(self)
+
+    def registered(self, user_id):
+        self.user_id = user_id
+        self.swarm.latencies.add('auth', reactor.seconds() - self.__connected_at)
+
+    def authorized(self, data):
+        self.swarm.latencies.add('auth', reactor.seconds() - self.__connected_at)
+
+    def auth_failed(self):
+        self.swarm.count('auth failures')
+        self.leave()
+
+    def idle(self):
+        if self.leaving:
+            return
+        self.__queued_at = reactor.seconds()
+        self.queue(**self.swarm.queue_options)
+
+    def game_started(self, state):
+        self.swarm.latencies.add('queue-to-start', reactor.seconds() - self.__queued_at)
+
+    def game_updated(self, state):
+        if self.__moved_at is not None:
+            self.swarm.latencies.add('move-to-update', reactor.seconds() - self.__moved_at)
+            self.__moved_at = None
+
+    def game_ended(self, state):
+        self.swarm.count('games')
+        if random.random() < self.swarm.churn:
+            self.leave()
+
+    def your_turn(self, state):
+        field = state['field']
+        free = [(x, y) for y, row in enumerate(field) for x, cell in enumerate(row) if cell is None]
+        self.__moved_at = reactor.seconds()
+        self.swarm.count('moves')
+        self.move(*random.choice(free))
+
+    def move_done(self, success):
+        if not success:
+            self.swarm.count('failed moves')
+
+    def leave(self):
+        self.leaving = True
+        self.transport.loseConnection()
+
+
+class Swarm(object):
+    def __init__(self, host, port, bots, rate, churn, queue_options):
+        """
+        :param host:
+        :param port:
+        :param bots: concurrent connections to keep
+        :param rate: new connections per second
+        :param churn: probability of reconnecting after a game
+        :param queue_options: sent with queue command
+        """
+        self.host = host
+        self.port = port
+        self.bots = bots
+        self.rate = rate
+        self.churn = churn
+        self.queue_options = queue_options
+        self.latencies = Latencies()
+        self.counters = {}
+        self.connections = 0
+        self.__returning = deque()
+        self.__arrivals = 0.0
+        self.__reported = {}
+        self.__spawner = task.LoopingCall(self.spawn)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def start(self):
+        self.__spawner.start(SPAWN_INTERVAL)
+
+    def spawn(self):
+        """connects bots arrived since the previous call, churned ones come back first
+
+        :return:
+        """
+        self.__arrivals += self.rate * SPAWN_INTERVAL
+        while self.__arrivals >= 1 and self.connections < self.bots:
+            self.__arrivals -= 1
+            self.connect(self.__returning.popleft() if self.__returning else None)
+        self.__arrivals = min(self.__arrivals, 1.0)
+
+    def connect(self, user_id):
+        self.connections += 1
+        endpoint = TCP4ClientEndpoint(reactor, self.host, self.port)
+        connectProtocol(endpoint, Bot(self, user_id)).addErrback(self.connect_failed)
+
+    def connect_failed(self, failure):
+        self.connections -= 1
+        self.count('connect failures')
+
+    def bot_lost(self, bot):
+        self.connections -= 1
+        if bot.leaving:
+            self.count('reconnects')
+        else:
+            self.count('dropped')
+        if bot.user_id:
+            self.__returning.append(bot.user_id)
+
+    def report(self, interval):
+        """prints counters per second since the previous report
+
+        :param interval: seconds since the previous report
+        :return:
+        """
+        rates = []
+        for name in sorted(self.counters):
+            done = self.counters[name] - self.__reported.get(name, 0)
+            rates.append('%s %.1f/s' % (name, done / float(interval)))
+        self.__reported = dict(self.counters)
+        print('connections %s | %s' % (self.connections, ', '.join(rates)))
+
+    def summary(self, duration):
+        print('--- %s bots, %.0f s' % (self.bots, duration))
+        for name in sorted(self.counters):
+            print('  %-15s %s (%.1f/s)' % (name, self.counters[name], self.counters[name] / duration))
+        for line in self.latencies.report():
+            print(line)
+
+
+def raise_open_files_limit():
+    """every bot is a socket, allow as many as hard limit lets
+
+    :return:
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Tic-tac-toe server load generator')
+    parser.add_argument('host', nargs='?', default='localhost')
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--bots', type=int, default=1000, help='concurrent connections')
+    parser.add_argument('--rate', type=float, default=100, help='new connections per second')
+    parser.add_argument('--churn', type=float, default=0.1, help='probability of reconnecting after a game')
+    parser.add_argument('--duration', type=float, default=60, help='seconds')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between progress reports')
+    parser.add_argument('--level', default='easy', help='AI level for bots nobody was paired with')
+    parser.add_argument('--size', type=int, default=3)
+    parser.add_argument('--win', type=int)
+    args = parser.parse_args()
+
+    raise_open_files_limit()
+    options = {'level': args.level, 'size': args.size, 'win': args.win or args.size}
+    swarm = Swarm(args.host, args.port, args.bots, args.rate, args.churn, options)
+    swarm.start()
+    reports = task.LoopingCall(swarm.report, args.interval)
+    reports.start(args.interval, now=False)
+
+    def finish():
+        reports.stop()
+        swarm.summary(args.duration)
+        reactor.stop()
+    reactor.callLater(args.duration, finish)
+    reactor.run()
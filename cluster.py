@@ -0,0 +1,614 @@
+"""
+Multi-process mode: supervisor process owns listening socket, user store and matchmaking (coordinator),
+worker processes share listening socket and run TTTServer protocols and games.
+
+Game of two players connected to different workers is hosted by worker of cross player. Updates for the other player
+and his moves are relayed through coordinator.
+"""
+import os
+import socket
+import sys
+from functools import partial
+from itertools import count
+from pickle import HIGHEST_PROTOCOL, dumps, loads
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ClientCreator, Factory, ProcessProtocol
+from twisted.protocols import amp
+from twisted.python import log
+
+import admin
+import metrics
+import profiler
+import settings
+import timers
+import user
+from encoding import SharedState
+from matchmaking import MatchQueue, RatingPolicy
+
+LISTENER_FD = 3
+
+
+class PickleArgument(amp.Argument):
+    """
+    Users and game states are passed between our own processes only, so pickle is fine here
+    """
+    def toString(self, inObject):
+        return dumps(inObject, HIGHEST_PROTOCOL)
+
+    def fromString(self, inString):
+        return loads(inString)
+
+
+class Register(amp.Command):
+    arguments = []
+    response = [('user', PickleArgument()), ('token', amp.Integer())]
+
+
+class Login(amp.Command):
+    arguments = [('user_id', amp.Unicode())]
+    response = [('user', PickleArgument()), ('token', amp.Integer())]
+
+
+class Logout(amp.Command):
+    arguments = [('user_id', amp.Unicode()), ('token', amp.Integer())]
+    requiresAnswer = False
+
+
+class SaveUser(amp.Command):
+    arguments = [('user', PickleArgument())]
+    requiresAnswer = False
+
+
+class UserChanged(amp.Command):
+    arguments = [('user', PickleArgument())]
+    requiresAnswer = False
+
+
+class Kick(amp.Command):
+    arguments = [('user_id', amp.Unicode())]
+    requiresAnswer = False
+
+
+class Enqueue(amp.Command):
+    arguments = [('user_id', amp.Unicode()), ('size', amp.Integer()), ('win', amp.Integer())]
+    requiresAnswer = False
+
+
+class Dequeue(amp.Command):
+    arguments = [('user_id', amp.Unicode())]
+    requiresAnswer = False
+
+
+class HostGame(amp.Command):
+    """circle is None for game against AI"""
+    arguments = [('cross', PickleArgument()), ('circle', PickleArgument()),
+                 ('size', amp.Integer()), ('win', amp.Integer())]
+    requiresAnswer = False
+
+
+class Deliver(amp.Command):
+    """kind is one of 'start', 'delta', 'end' - matching TTTServer start_game, send_game_delta, end_game"""
+    arguments = [('user_id', amp.Unicode()), ('kind', amp.String()), ('state', PickleArgument())]
+    requiresAnswer = False
+
+
+class RemoteMove(amp.Command):
+    arguments = [('user_id', amp.Unicode()), ('x', amp.Integer()), ('y', amp.Integer())]
+    response = [('success', amp.Boolean())]
+
+
+class RemoteDrop(amp.Command):
+    arguments = [('user_id', amp.Unicode())]
+    requiresAnswer = False
+
+
+class Pause(amp.Command):
+    """backpressure: store of coordinator is behind, workers stop reading from clients until Resume"""
+    arguments = []
+    requiresAnswer = False
+
+
+class Resume(amp.Command):
+    arguments = []
+    requiresAnswer = False
+
+
+class Coordinator(object):
+    """
+    Shared state of all workers: user store, who is online where, matchmaking queue and hosts of relayed games
+    """
+    def __init__(self, user_manager):
+        """
+        :param user_manager:
+        :type user_manager: user.UserManager
+        """
+        self.users = user_manager
+        self.users.on_pause = self.pause_workers
+        self.workers = set()
+        self.online = {}
+        self.hosts = {}
+        self.queues = {}
+        self.queued = {}
+        self.__tokens = count(1)
+
+    def login(self, worker, user_id):
+        """marks user as online at worker, disconnecting older connection of the same user on any worker
+
+        :param worker:
+        :param user_id:
+        :return:
+        """
+        if user_id in self.online:
+            self.online[user_id][0].callRemote(Kick, user_id=user_id)
+        token = next(self.__tokens)
+        self.online[user_id] = (worker, token)
+        self.users.users.pin(user_id)
+        return token
+
+    def logout(self, user_id, token):
+        if self.online.get(user_id, (None, None))[1] == token:
+            del self.online[user_id]
+            self.dequeue(user_id)
+            self.users.users.unpin(user_id)
+
+    def save_user(self, worker, changed):
+        """stores user and sends it to the worker where user is connected if it was changed by other one
+
+        :param worker:
+        :param changed:
+        :return:
+        """
+        self.users.users[changed.user_id] = changed
+        self.users.save_user(changed)
+        owner = self.online.get(changed.user_id, (None, None))[0]
+        if owner is not None and owner is not worker:
+            owner.callRemote(UserChanged, user=changed)
+
+    def enqueue(self, user_id, variant):
+        if user_id in self.queued:
+            return
+        if variant not in self.queues:
+            self.queues[variant] = MatchQueue(RatingPolicy(self.rating))
+        self.queues[variant].push(user_id, user_id)
+        self.queued[user_id] = variant
+        self.match(variant, [user_id])
+
+    def rating(self, user_id):
+        return self.users.users[user_id].rating
+
+    def dequeue(self, user_id):
+        variant = self.queued.pop(user_id, None)
+        if variant is None:
+            return
+        queue = self.queues[variant]
+        queue.remove(user_id)
+        if queue.isEmpty():
+            self.cancel_match_timer(variant)
+
+    def host_game(self, variant, cross_id, circle_id=None):
+        """asks worker of cross player to host the game
+
+        :param variant:
+        :param cross_id:
+        :param circle_id: None for game against AI
+        :return:
+        """
+        host = self.online[cross_id][0]
+        circle = None
+        if circle_id is not None:
+            circle = self.users.users[circle_id]
+            if self.online[circle_id][0] is not host:
+                self.hosts[circle_id] = host
+        size, win_length = variant
+        host.callRemote(HostGame, cross=self.users.users[cross_id], circle=circle, size=size, win=win_length)
+
+    def match(self, variant, user_ids=None):
+        """pairs players queued for variant regardless of their workers. Players left unpaired are matched again
+        every MATCH_TICK with wider rating window
+
+        :param variant:
+        :param user_ids: players to find partners for, everyone queued by default
+        :return:
+        """
+        queue = self.queues[variant]
+        for cross_id, circle_id in queue.match(user_ids):
+            del self.queued[cross_id], self.queued[circle_id]
+            self.host_game(variant, cross_id, circle_id)
+        if queue and ('queue', variant) not in timers.wheel:
+            timers.wheel.schedule(('queue', variant), settings.MATCH_TICK, partial(self.match_tick, variant))
+
+    def match_tick(self, variant):
+        self.match(variant)
+        self.start_ai_game(variant)
+
+    def cancel_match_timer(self, variant):
+        timers.wheel.cancel(('queue', variant))
+
+    def start_ai_game(self, variant):
+        """hosts games with AI for players who waited for WAIT_TIMEOUT without partner in their rating window
+
+        :param variant:
+        :return:
+        """
+        for user_id in self.queues[variant].overdue(settings.WAIT_TIMEOUT):
+            del self.queued[user_id]
+            self.host_game(variant, user_id)
+
+    def deliver(self, user_id, kind, state):
+        if kind == 'end':
+            self.hosts.pop(user_id, None)
+        if user_id in self.online:
+            self.online[user_id][0].callRemote(Deliver, user_id=user_id, kind=kind, state=state)
+
+    def remote_move(self, user_id, x, y):
+        host = self.hosts.get(user_id)
+        if host is None:
+            return {'success': False}
+        return host.callRemote(RemoteMove, user_id=user_id, x=x, y=y)
+
+    def remote_drop(self, user_id):
+        host = self.hosts.pop(user_id, None)
+        if host is not None:
+            host.callRemote(RemoteDrop, user_id=user_id)
+
+    def worker_joined(self, worker):
+        self.workers.add(worker)
+        if self.users.paused:
+            worker.callRemote(Pause)
+
+    def pause_workers(self, paused):
+        """relays backpressure of user store to all workers
+
+        :param paused:
+        :return:
+        """
+        for worker in self.workers:
+            worker.callRemote(Pause if paused else Resume)
+
+    def worker_lost(self, worker):
+        """forgets users of dead worker. Their relayed games are forfeited, games hosted by it are lost for
+        players of other workers, so those are disconnected
+
+        :param worker:
+        :return:
+        """
+        self.workers.discard(worker)
+        for user_id, (owner, token) in list(self.online.items()):
+            if owner is worker:
+                self.logout(user_id, token)
+                self.remote_drop(user_id)
+        for user_id, host in list(self.hosts.items()):
+            if host is worker:
+                del self.hosts[user_id]
+                if user_id in self.online:
+                    self.online[user_id][0].callRemote(Kick, user_id=user_id)
+
+
+class CoordinatorProtocol(amp.AMP):
+    """
+    Coordinator side of connection with single worker
+    """
+    def __init__(self, coordinator):
+        amp.AMP.__init__(self)
+        self.coordinator = coordinator
+
+    def connectionMade(self):
+        amp.AMP.connectionMade(self)
+        self.coordinator.worker_joined(self)
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.coordinator.worker_lost(self)
+
+    @Register.responder
+    def register(self):
+        new_user = self.coordinator.users.create_user()
+        return {'user': new_user, 'token': self.coordinator.login(self, new_user.user_id)}
+
+    @Login.responder
+    def login(self, user_id):
+        found = self.coordinator.users.get_user(user_id)
+        if not found:
+            return {'user': None, 'token': 0}
+        return {'user': found, 'token': self.coordinator.login(self, user_id)}
+
+    @Logout.responder
+    def logout(self, user_id, token):
+        self.coordinator.logout(user_id, token)
+        return {}
+
+    @SaveUser.responder
+    def save_user(self, user):
+        self.coordinator.save_user(self, user)
+        return {}
+
+    @Enqueue.responder
+    def enqueue(self, user_id, size, win):
+        self.coordinator.enqueue(user_id, (size, win))
+        return {}
+
+    @Dequeue.responder
+    def dequeue(self, user_id):
+        self.coordinator.dequeue(user_id)
+        return {}
+
+    @Deliver.responder
+    def deliver(self, user_id, kind, state):
+        self.coordinator.deliver(user_id, kind, state)
+        return {}
+
+    @RemoteMove.responder
+    def remote_move(self, user_id, x, y):
+        return self.coordinator.remote_move(user_id, x, y)
+
+    @RemoteDrop.responder
+    def remote_drop(self, user_id):
+        self.coordinator.remote_drop(user_id)
+        return {}
+
+
+class CoordinatorFactory(Factory):
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+
+    def buildProtocol(self, addr):
+        return CoordinatorProtocol(self.coordinator)
+
+
+class RemoteProtocol(object):
+    """
+    Stands for TTTServer of player connected to other worker in game hosted by this one
+    """
+    def __init__(self, link, user_id):
+        self.__link = link
+        self.__user_id = user_id
+
+    def start_game(self, shared_state, your_type):
+        self.__link.deliver(self.__user_id, 'start', dict(shared_state.state, your_type=your_type))
+
+    def send_game_delta(self, delta, encoded=None):
+        self.__link.deliver(self.__user_id, 'delta', delta)
+
+    def end_game(self):
+        self.__link.deliver(self.__user_id, 'end', None)
+        self.__link.user_manager.detach(self.__user_id)
+
+
+class WorkerLink(amp.AMP):
+    """
+    Worker side of connection with coordinator
+    """
+    game_manager = None
+    user_manager = None
+
+    def enqueue(self, user_id, variant):
+        size, win_length = variant
+        self.callRemote(Enqueue, user_id=user_id, size=size, win=win_length)
+
+    def dequeue(self, user_id):
+        self.callRemote(Dequeue, user_id=user_id)
+
+    def deliver(self, user_id, kind, state):
+        self.callRemote(Deliver, user_id=user_id, kind=kind, state=state)
+
+    def remote_move(self, user_id, x, y):
+        """
+        :return: deferred fired with move result from the hosting worker
+        """
+        d = self.callRemote(RemoteMove, user_id=user_id, x=x, y=y)
+        return d.addCallback(lambda response: response['success'])
+
+    def remote_drop(self, user_id):
+        self.callRemote(RemoteDrop, user_id=user_id)
+
+    @Kick.responder
+    def kick(self, user_id):
+        proto = self.user_manager.protocols.get(user_id)
+        if proto is not None and not isinstance(proto, RemoteProtocol):
+            proto.transport.loseConnection()
+        return {}
+
+    @UserChanged.responder
+    def user_changed(self, user):
+        local = self.user_manager.users.get(user.user_id)
+        if local is not None:
+            local.wins, local.loses, local.ties, local.rating = user.wins, user.loses, user.ties, user.rating
+        return {}
+
+    @HostGame.responder
+    def host_game(self, cross, circle, size, win):
+        players = [self.user_manager.attach(player) for player in (cross, circle) if player is not None]
+        self.game_manager.begin_session(self.game_manager.create_session(*players, variant=(size, win)))
+        return {}
+
+    @Deliver.responder
+    def delivered(self, user_id, kind, state):
+        proto = self.user_manager.protocols.get(user_id)
+        if kind == 'start':
+            self.game_manager.remote_games.add(user_id)
+        elif kind == 'end':
+            self.game_manager.remote_games.discard(user_id)
+        if proto is None:
+            return {}
+        if kind == 'start':
+            your_type = state.pop('your_type')
+            proto.start_game(SharedState(state), your_type)
+        elif kind == 'delta':
+            proto.send_game_delta(state)
+        elif kind == 'end':
+            proto.end_game()
+        return {}
+
+    @RemoteMove.responder
+    def moved(self, user_id, x, y):
+        return {'success': bool(self.game_manager.make_move(user_id, x, y))}
+
+    @RemoteDrop.responder
+    def dropped(self, user_id):
+        self.game_manager.drop_player(user_id)
+        return {}
+
+    @Pause.responder
+    def pause(self):
+        self.user_manager.pause_clients(True)
+        return {}
+
+    @Resume.responder
+    def resume(self):
+        self.user_manager.pause_clients(False)
+        return {}
+
+
+class RemoteUserManager(object):
+    """
+    UserManager for worker process: users live in coordinator, here are only those who are connected to this worker
+    or play games hosted by it
+    """
+    def __init__(self, link):
+        """
+        :param link:
+        :type link: WorkerLink
+        """
+        self.__link = link
+        self.__tokens = {}
+        self.users = {}
+        self.paused = False
+        self.protocols = {}
+
+    def get_user_stats(self, user_id):
+        if user_id in self.users:
+            return self.users[user_id].stats
+        return False
+
+    def register_new_user(self, proto):
+        d = self.__link.callRemote(Register)
+        return d.addCallback(self.logged_in, proto)
+
+    def auth_user(self, user_id, proto):
+        if not isinstance(user_id, basestring):
+            return False
+        d = self.__link.callRemote(Login, user_id=user_id)
+        return d.addCallback(self.logged_in, proto)
+
+    def logged_in(self, response, proto):
+        logged = response['user']
+        if logged is None:
+            return False
+        self.users[logged.user_id] = logged
+        self.protocols[logged.user_id] = proto
+        self.__tokens[logged.user_id] = response['token']
+        return logged
+
+    def remove_user(self, user_id):
+        self.users.pop(user_id, None)
+        token = self.__tokens.pop(user_id, None)
+        if token is not None:
+            self.__link.callRemote(Logout, user_id=user_id, token=token)
+            return True
+        return False
+
+    def attach(self, player):
+        """returns local user for player connected to this worker, otherwise registers player relayed through
+        coordinator
+
+        :param player:
+        :return:
+        """
+        if player.user_id in self.__tokens:
+            return self.users[player.user_id]
+        self.users[player.user_id] = player
+        self.protocols[player.user_id] = RemoteProtocol(self.__link, player.user_id)
+        return player
+
+    def detach(self, user_id):
+        if user_id not in self.__tokens:
+            self.users.pop(user_id, None)
+            self.protocols.pop(user_id, None)
+
+    def save_user(self, changed):
+        self.__link.callRemote(SaveUser, user=changed)
+
+    def save_users(self):
+        pass
+
+    def pause_clients(self, paused):
+        """Backpressure sent by coordinator: stop reading from clients of this worker while its store is behind
+
+        :param paused:
+        :return:
+        """
+        self.paused = paused
+        for proto in self.protocols.values():
+            if isinstance(proto, RemoteProtocol):
+                continue
+            if paused:
+                proto.transport.pauseProducing()
+            else:
+                proto.transport.resumeProducing()
+
+
+def install_user_manager(manager):
+    """replaces module-wide user manager, so User.protocol looks protocols up in it
+
+    :param manager:
+    :return:
+    """
+    user.user_mananger = manager
+    return manager
+
+
+def connect_worker():
+    """connects worker process to coordinator
+
+    :return: deferred fired with WorkerLink
+    """
+    return ClientCreator(reactor, WorkerLink).connectUNIX(settings.COORDINATOR_SOCKET)
+
+
+class WorkerProcess(ProcessProtocol):
+    def __init__(self, number):
+        self.number = number
+
+    def processEnded(self, reason):
+        log.msg('Worker %s exited: %s' % (self.number, reason.value))
+
+
+def run_supervisor(workers, port):
+    """Starts coordinator and spawns worker processes which share single listening socket
+
+    :param workers:
+    :param port:
+    :return:
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', port))
+    listener.listen(socket.SOMAXCONN)
+    listener.setblocking(False)
+
+    user.user_mananger.load_users()
+    if os.path.exists(settings.COORDINATOR_SOCKET):
+        os.remove(settings.COORDINATOR_SOCKET)
+    coordinator = Coordinator(user.user_mananger)
+    reactor.listenUNIX(settings.COORDINATOR_SOCKET, CoordinatorFactory(coordinator))
+    metrics.registry.gauge('online_users', lambda: len(coordinator.online))
+    metrics.registry.gauge('queued_players', lambda: sum(len(queue) for queue in coordinator.queues.values()))
+    admin.start(settings.ADMIN_PORT)
+    profiler.install_signal()
+
+    processes = []
+    script = os.path.abspath(sys.argv[0])
+    for number in range(workers):
+        processes.append(reactor.spawnProcess(
+            WorkerProcess(number), sys.executable, [sys.executable, script, '--worker', str(number)], env=os.environ,
+            childFDs={0: 0, 1: 1, 2: 2, LISTENER_FD: listener.fileno()}))
+    listener.close()
+
+    def stop_workers():
+        for process in processes:
+            if process.pid:
+                process.signalProcess('TERM')
+    reactor.addSystemEventTrigger('before', 'shutdown', stop_workers)
+    reactor.addSystemEventTrigger('before', 'shutdown', user.user_mananger.save_users)
+    reactor.run()
@@ -0,0 +1,76 @@
+from json import dumps
+
+# fields of game state with player info
+HEADERS = ('player_x', 'player_o')
+
+
+def encode(data):
+    """wire form of message, without line delimiter
+
+    :param data:
+    :return:
+    """
+    return dumps(data).encode()
+
+
+class SharedState(object):
+    """
+    Game state shared by all recipients of one game. It's encoded once per change, field `your_type` which is the
+    only one differing between recipients is spliced into encoded state for each of them. Player headers don't
+    change during the game, they are encoded once and spliced as well
+    """
+
+    def __init__(self, state, headers=None):
+        """
+        :param state: state dict, see main.GameSession.game_state. It's owned by this object from now on
+        :type state: dict
+        :param headers: player headers encoded by field, see main.GameSession.headers. Encoded here if not given
+        :type headers: dict
+        """
+        state.pop('your_type', None)
+        self.players = dict((field, state.pop(field)) for field in HEADERS)
+        if headers is None:
+            headers = dict((field, encode(header)) for field, header in self.players.items())
+        self.__headers = b''.join(b', "%s": %s' % (field, headers[field]) for field in HEADERS)
+        self.__state = state
+        self.__encoded = None
+        self.__spliced = {}
+
+    @property
+    def state(self):
+        """
+        :return: copy of the whole state
+        """
+        return dict(self.__state, **self.players)
+
+    def apply(self, delta):
+        """applies change of state once, no matter how many recipients pass it here
+
+        :param delta: see main.GameSession.delta
+        :return:
+        """
+        state = self.__state
+        if delta['seq'] <= state['seq']:
+            return
+        if delta['move'] is not None:
+            x, y = delta['move']
+            state['field'][y][x] = delta['sign']
+            state['last_turn'] = delta['sign']
+        state['seq'] = delta['seq']
+        state['ended'] = delta['ended']
+        state['winner'] = delta['winner']
+        self.__encoded = None
+        self.__spliced = {}
+
+    def encoded(self, your_type):
+        """
+        :param your_type: sign of recipient
+        :return: encoded state with recipient sign
+        """
+        line = self.__spliced.get(your_type)
+        if line is None:
+            if self.__encoded is None:
+                self.__encoded = encode(self.__state)[:-1] + self.__headers
+            line = self.__encoded + b', "your_type": ' + encode(your_type) + b'}'
+            self.__spliced[your_type] = line
+        return line
@@ -0,0 +1,241 @@
+from time import time
+
+WIN = 1000000
+EXACT = 0
+LOWER = 1
+UPPER = 2
+# symmetry reduction pays off only on small boards, on bigger ones transforming masks costs more than it saves
+SYMMETRY_MAX_CELLS = 49
+# boards bigger than this only consider cells next to already placed signs
+NEIGHBOURHOOD_MIN_SIZE = 5
+TIME_CHECK_EVERY = 256
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class Engine(object):
+    """
+    Alpha-beta negamax over bit masks of the field (see game.Field). Position is a pair of masks:
+    signs of player to move and signs of his opponent.
+
+    Searched positions are kept in transposition table keyed by canonical form of position - smallest of its 8
+    rotations and reflections, so equal and symmetric positions are searched only once for all games on this board
+    """
+
+    def __init__(self, size, win_length, windows, table_size=100000):
+        """
+        :param size:
+        :param win_length:
+        :param windows: masks of win windows through every cell, see game.Rules.windows_through_cells
+        :param table_size: transposition table is cleared when it grows bigger
+        """
+        self.size = size
+        self.win_length = win_length
+        self.cells = size * size
+        self.full = (1 << self.cells) - 1
+        self.__windows = windows
+        self.__all_windows = tuple(sorted(set(window for masks in windows for window in masks)))
+        self.__table = {}
+        self.__table_size = table_size
+        self.__nodes = 0
+        self.__deadline = None
+        center = (size - 1) / 2.0
+        self.__order = tuple(sorted(range(self.cells),
+                                    key=lambda cell: abs(cell % size - center) + abs(cell // size - center)))
+        self.__neighbours = tuple(self.neighbourhood(cell) for cell in range(self.cells))
+        self.__symmetries = []
+        if self.cells <= SYMMETRY_MAX_CELLS:
+            self.__symmetries = [self.byte_tables(permutation) for permutation in self.permutations()]
+
+    def neighbourhood(self, cell):
+        x, y = cell % self.size, cell // self.size
+        mask = 0
+        for ny in range(max(0, y - 1), min(self.size, y + 2)):
+            for nx in range(max(0, x - 1), min(self.size, x + 2)):
+                mask |= 1 << (ny * self.size + nx)
+        return mask
+
+    def permutations(self):
+        """cell permutations for all 8 symmetries of the square, identity first
+
+        :return:
+        """
+        n = self.size - 1
+        transforms = (
+            lambda x, y: (x, y), lambda x, y: (n - y, x), lambda x, y: (n - x, n - y), lambda x, y: (y, n - x),
+            lambda x, y: (n - x, y), lambda x, y: (x, n - y), lambda x, y: (y, x), lambda x, y: (n - y, n - x),
+        )
+        permutations = []
+        for transform in transforms:
+            permutation = []
+            for cell in range(self.cells):
+                x, y = transform(cell % self.size, cell // self.size)
+                permutation.append(y * self.size + x)
+            permutations.append(tuple(permutation))
+        return permutations
+
+    def byte_tables(self, permutation):
+        """lookup tables transforming mask byte by byte
+
+        :param permutation:
+        :return: (permutation, inverse permutation, tables)
+        """
+        inverse = [0] * self.cells
+        for cell, target in enumerate(permutation):
+            inverse[target] = cell
+        tables = []
+        for offset in range(0, self.cells, 8):
+            table = []
+            for value in range(256):
+                mask = 0
+                for bit in range(8):
+                    if value & (1 << bit) and offset + bit < self.cells:
+                        mask |= 1 << permutation[offset + bit]
+                table.append(mask)
+            tables.append(tuple(table))
+        return permutation, tuple(inverse), tuple(tables)
+
+    @staticmethod
+    def transform(mask, tables):
+        result = 0
+        for table in tables:
+            result |= table[mask & 0xff]
+            mask >>= 8
+        return result
+
+    def canonical(self, own, other):
+        """
+        :return: canonical key of position and symmetry which transforms position into it
+        """
+        if not self.__symmetries:
+            return (own, other), None
+        best_key, best_symmetry = None, None
+        for symmetry in self.__symmetries:
+            tables = symmetry[2]
+            key = (self.transform(own, tables), self.transform(other, tables))
+            if best_key is None or key < best_key:
+                best_key, best_symmetry = key, symmetry
+        return best_key, best_symmetry
+
+    def is_win(self, mask, cell):
+        for window in self.__windows[cell]:
+            if mask & window == window:
+                return True
+        return False
+
+    def candidates(self, occupied):
+        """empty cells worth trying, center first
+
+        :param occupied:
+        :return:
+        """
+        allowed = self.full
+        if self.size >= NEIGHBOURHOOD_MIN_SIZE and occupied:
+            allowed = 0
+            for cell in range(self.cells):
+                if occupied >> cell & 1:
+                    allowed |= self.__neighbours[cell]
+        allowed &= ~occupied
+        return [cell for cell in self.__order if allowed >> cell & 1]
+
+    def evaluate(self, own, other):
+        """heuristic value of position for player to move: windows still open for him minus those open for opponent
+
+        :param own:
+        :param other:
+        :return:
+        """
+        score = 0
+        for window in self.__all_windows:
+            if not window & other:
+                score += 1 << (2 * bin(window & own).count('1'))
+            elif not window & own:
+                score -= 1 << (2 * bin(window & other).count('1'))
+        return score
+
+    def search(self, own, other, depth, alpha, beta):
+        """negamax value of position for player to move
+
+        :return: score, best move
+        """
+        self.__nodes += 1
+        if self.__deadline is not None and self.__nodes % TIME_CHECK_EVERY == 0 and time() > self.__deadline:
+            raise SearchTimeout()
+        key, symmetry = self.canonical(own, other)
+        entry = self.__table.get(key)
+        best_move = None
+        if entry is not None:
+            entry_depth, value, flag, stored_move = entry
+            if stored_move is not None:
+                best_move = stored_move if symmetry is None else symmetry[1][stored_move]
+            if entry_depth >= depth:
+                if flag == EXACT:
+                    return value, best_move
+                if flag == LOWER:
+                    alpha = max(alpha, value)
+                elif flag == UPPER:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value, best_move
+        occupied = own | other
+        if occupied == self.full:
+            return 0, None
+        if depth == 0:
+            return self.evaluate(own, other), None
+        moves = self.candidates(occupied)
+        if best_move in moves:
+            moves.remove(best_move)
+            moves.insert(0, best_move)
+        start_alpha = alpha
+        best = -WIN * 2
+        for cell in moves:
+            placed = own | (1 << cell)
+            if self.is_win(placed, cell):
+                value = WIN + depth
+            else:
+                value = -self.search(other, placed, depth - 1, -beta, -alpha)[0]
+            if value > best:
+                best, best_move = value, cell
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+        flag = EXACT
+        if best <= start_alpha:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        if len(self.__table) >= self.__table_size:
+            self.__table.clear()
+        stored_move = best_move if symmetry is None else symmetry[0][best_move]
+        self.__table[key] = (depth, best, flag, stored_move)
+        return best, best_move
+
+    def best_move(self, own, other, depth, time_limit=None):
+        """Picks move for player to move with iterative deepening: searches 1, 2, ... plies deep until depth is
+        reached or time is out, moves found by previous iterations are tried first by next ones.
+        Always returns legal move: first iteration is never interrupted, interrupted one is thrown away
+
+        :param own: mask of signs of player to move
+        :param other: mask of opponent signs
+        :param depth: search depth in plies
+        :param time_limit: seconds
+        :return: (x, y)
+        """
+        self.__nodes = 0
+        deadline = time() + time_limit if time_limit else None
+        empty_cells = self.cells - bin(own | other).count('1')
+        best_move = None
+        try:
+            for current_depth in range(1, min(depth, empty_cells) + 1):
+                if best_move is not None:
+                    self.__deadline = deadline
+                value, best_move = self.search(own, other, current_depth, -WIN * 2, WIN * 2)
+                if abs(value) >= WIN or (deadline is not None and time() > deadline):
+                    break
+        except SearchTimeout:
+            pass
+        finally:
+            self.__deadline = None
+        return best_move % self.size, best_move // self.size
@@ -0,0 +1,173 @@
+"""
+Wire framings of client connection. Every connection starts with JSON lines, client may ask for binary frames
+in `auth` or `reg` command and both sides switch to them right after the answer.
+
+Binary frame is 2 bytes of payload length followed by payload, first byte of payload is its type:
+
+* JSON - rest of payload is JSON command, used for everything without own layout
+* MOVE - client move: x, y
+* MOVE_DONE - answer to move: success
+* DELTA - game state change: seq, x, y, sign, ended, winner (see main.GameSession.delta)
+* PING, PONG - heartbeat, no data
+"""
+from json import loads
+from struct import Struct, error as StructError
+
+from twisted.protocols.basic import LineReceiver
+
+import settings
+from encoding import encode
+
+JSON = 0
+MOVE = 1
+MOVE_DONE = 2
+DELTA = 3
+PING = 4
+PONG = 5
+
+FRAME_HEADER = Struct('>H')
+MOVE_FRAME = Struct('>BBB')
+MOVE_DONE_FRAME = Struct('>BB')
+DELTA_FRAME = Struct('>BIBBBBB')
+NO_CELL = 0xff
+SIGN_CODES = {None: 0, settings.CROSS: 1, settings.CIRCLE: 2}
+SIGNS = dict((code, sign) for sign, code in SIGN_CODES.items())
+HEARTBEATS = {'ping': PING, 'pong': PONG}
+HEARTBEAT_COMMANDS = dict((kind, command) for command, kind in HEARTBEATS.items())
+
+
+class JSONLines(object):
+    name = 'json'
+
+    @staticmethod
+    def encode(data):
+        return encode(data)
+
+    @staticmethod
+    def from_json(encoded):
+        """
+        :param encoded: command already encoded as JSON
+        :return: payload
+        """
+        return encoded
+
+    @staticmethod
+    def decode(payload):
+        """
+        :param payload:
+        :return: command or False if it can't be decoded
+        """
+        try:
+            return loads(payload)
+        except Exception:
+            return False
+
+    @staticmethod
+    def frame(payload):
+        return payload + LineReceiver.delimiter
+
+
+class BinaryFrames(object):
+    name = 'binary'
+
+    @staticmethod
+    def encode(data):
+        command = data.get('cmd')
+        if command == 'delta':
+            x, y = data['move'] if data['move'] is not None else (NO_CELL, NO_CELL)
+            return DELTA_FRAME.pack(DELTA, data['seq'], x, y, SIGN_CODES[data['sign']], int(data['ended']),
+                                    SIGN_CODES[data['winner']])
+        if command in HEARTBEATS and len(data) == 1:
+            return chr(HEARTBEATS[command])
+        if command == 'move' and 'success' in data:
+            return MOVE_DONE_FRAME.pack(MOVE_DONE, int(data['success']))
+        if command == 'move':
+            return MOVE_FRAME.pack(MOVE, *data['pos'])
+        return BinaryFrames.from_json(encode(data))
+
+    @staticmethod
+    def from_json(encoded):
+        return chr(JSON) + encoded
+
+    @staticmethod
+    def decode(payload):
+        try:
+            kind = ord(payload[0])
+            if kind == JSON:
+                return loads(payload[1:])
+            if kind == MOVE:
+                x, y = MOVE_FRAME.unpack(payload)[1:]
+                return {'cmd': 'move', 'pos': [x, y]}
+            if kind == MOVE_DONE:
+                return {'cmd': 'move', 'success': bool(MOVE_DONE_FRAME.unpack(payload)[1])}
+            if kind in HEARTBEAT_COMMANDS:
+                return {'cmd': HEARTBEAT_COMMANDS[kind]}
+            if kind == DELTA:
+                seq, x, y, sign, ended, winner = DELTA_FRAME.unpack(payload)[1:]
+                return {'cmd': 'delta', 'move': [x, y] if x != NO_CELL else None, 'sign': SIGNS[sign], 'seq': seq,
+                        'ended': bool(ended), 'winner': SIGNS[winner]}
+        except (IndexError, KeyError, StructError, ValueError):
+            pass
+        return False
+
+    @staticmethod
+    def frame(payload):
+        return FRAME_HEADER.pack(len(payload)) + payload
+
+
+FRAMINGS = dict((framing.name, framing) for framing in (JSONLines, BinaryFrames))
+
+
+class FramedReceiver(LineReceiver):
+    """
+    Exchanges commands as JSON lines or, once switched, as binary frames. Subclasses get decoded commands
+    (or False for undecodable ones) in packetReceived whatever framing is used
+    """
+    framing = JSONLines
+    __frames = b''
+
+    def packetReceived(self, packet):
+        raise NotImplementedError
+
+    def switch_framing(self, name):
+        """changes framing of following data in both directions
+
+        :param name: one of FRAMINGS
+        :return:
+        """
+        self.framing = FRAMINGS[name]
+        self.__frames = b''
+        if self.framing is BinaryFrames:
+            self.setRawMode()
+        else:
+            self.setLineMode()
+
+    def lineReceived(self, line):
+        self.packetReceived(self.framing.decode(line))
+
+    def rawDataReceived(self, data):
+        self.__frames += data
+        offset = 0
+        while len(self.__frames) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self.__frames, offset)
+            if length > self.MAX_LENGTH:
+                self.__frames = b''
+                return self.lineLengthExceeded(data)
+            end = offset + FRAME_HEADER.size + length
+            if len(self.__frames) < end:
+                break
+            payload = self.__frames[offset + FRAME_HEADER.size:end]
+            offset = end
+            self.packetReceived(self.framing.decode(payload))
+            if self.framing is not BinaryFrames:
+                rest, self.__frames = self.__frames[offset:], b''
+                return self.setLineMode(rest)
+        self.__frames = self.__frames[offset:]
+
+    def send_payload(self, payload):
+        """sends payload encoded by current framing
+
+        :param payload:
+        :return:
+        """
+        self.transport.write(self.framing.frame(payload))
@@ -1,43 +1,74 @@
-from copy import deepcopy
-from random import randint
+from twisted.internet.defer import CancelledError
+from twisted.python import log
 
-from settings import CIRCLE, CROSS
+import metrics
+import table
+from engine import Engine
+from settings import AI_LEVEL, AI_LEVELS, AI_MOVE_TIME, AI_TABLE_SIZE, CIRCLE, CROSS, RATING_START
 from user import User
 
+# inside the engine signs are small int codes, Game takes and returns settings.CROSS/CIRCLE
+NOBODY = 0
+X = 1
+O = 2
+SIGN_CODES = {None: NOBODY, CROSS: X, CIRCLE: O}
+SIGNS = (None, CROSS, CIRCLE)
+
 
 class Field(object):
     """
-    We're presuming that field is organized as
-        array of rows
+    Field is stored as bit mask per sign, cell (x, y) is bit number y * size + x.
+    Presentation as array of rows is only built when field is serialized
 
     """
+    __slots__ = ('_crosses', '_circles', '_occupied', '_size', '_free_cells')
 
     def __init__(self, size):
-        self._field = [[None for i in range(size)] for x in range(size)]
+        self._crosses = 0
+        self._circles = 0
+        self._occupied = 0
         self._size = size
         self._free_cells = size * size
-        pass
+
+    def cell(self, x, y):
+        """
+        :return: sign code
+        """
+        bit = 1 << (y * self._size + x)
+        if self._crosses & bit:
+            return X
+        if self._circles & bit:
+            return O
+        return NOBODY
+
+    def mask(self, sign):
+        """
+        :param sign: X or O
+        """
+        if sign == X:
+            return self._crosses
+        return self._circles
 
     def get_row(self, number):
         if 0 <= number < self._size:
-            return deepcopy(self._field[number])
+            return [self.cell(x, number) for x in range(self._size)]
         return False
 
     def get_column(self, number):
         if not (0 <= number < self._size):
             return False
-        return [i[number] for i in self._field]
+        return [self.cell(number, y) for y in range(self._size)]
 
     def get_diagonal(self, right=True):
         if right:
-            return [self._field[i][i] for i in range(self._size)]
-        return [self._field[i][self._size - i - 1] for i in range(self._size)]
+            return [self.cell(i, i) for i in range(self._size)]
+        return [self.cell(self._size - i - 1, i) for i in range(self._size)]
 
     def put_cross(self, x, y):
-        return self.put_sign(CROSS, x, y)
+        return self.put_sign(X, x, y)
 
     def put_circle(self, x, y):
-        return self.put_sign(CIRCLE, x, y)
+        return self.put_sign(O, x, y)
 
     def check_index(self, index):
         return 0 <= index < self._size
@@ -45,15 +76,23 @@ class Field(object):
     def put_sign(self, sign, x, y):
         if not (self.check_index(x) and self.check_index(y)):
             return False
-        if self._field[y][x] is not None:
+        bit = 1 << (y * self._size + x)
+        if self._occupied & bit:
             return False
-        self._field[y][x] = sign
+        if sign == X:
+            self._crosses |= bit
+        else:
+            self._circles |= bit
+        self._occupied |= bit
         self._free_cells -= 1
         return True
 
     @property
     def field(self):
-        return deepcopy(self._field)
+        """
+        :return: rows of settings.CROSS, settings.CIRCLE or None
+        """
+        return [[SIGNS[code] for code in self.get_row(y)] for y in range(self._size)]
 
     @property
     def is_full(self):
@@ -65,23 +104,58 @@ class Field(object):
 
 
 class Rules(object):
+    # direction steps (dx, dy): row, column, diagonal, anti-diagonal
+    DIRECTIONS = ((1, 0), (0, 1), (1, 1), (-1, 1))
+    __windows = {}
+    __slots__ = ('__win_length',)
+
+    def __init__(self, win_length=None):
+        """
+        :param win_length: signs in a row needed to win, whole row of the field if not set
+        """
+        self.__win_length = win_length
+
+    @classmethod
+    def windows_through_cells(cls, size, win_length):
+        """masks of every win_length long segment of rows, columns and diagonals passing through every cell.
+        Computed once per field size and win length, there are at most 4 * win_length of them for any cell
+
+        :param size:
+        :param win_length:
+        :return: tuple of window masks for each bit number
+        """
+        key = (size, win_length)
+        if key not in cls.__windows:
+            cells = [[] for i in range(size * size)]
+            for dx, dy in cls.DIRECTIONS:
+                for y in range(size):
+                    for x in range(size):
+                        end_x = x + dx * (win_length - 1)
+                        end_y = y + dy * (win_length - 1)
+                        if not (0 <= end_x < size and 0 <= end_y < size):
+                            continue
+                        window = [(y + dy * i) * size + x + dx * i for i in range(win_length)]
+                        mask = sum(1 << bit for bit in window)
+                        for bit in window:
+                            cells[bit].append(mask)
+            cls.__windows[key] = tuple(tuple(masks) for masks in cells)
+        return cls.__windows[key]
+
     def check_win_from_move(self, board, x, y):
-        """check if this move resulted in win
+        """check if this move resulted in win. Only windows around the move are checked, so cost depends on
+        win length, not on field size
 
         :param board:
         :type board: Field
         :param x:
         :param y:
         """
-        lines = []
-        lines.append(board.get_column(x))
-        lines.append(board.get_row(y))
-        if x == y:
-            lines.append(board.get_diagonal())
-        if x + y == board.size:
-            lines.append(board.get_diagonal(False))
-        for line in lines:
-            if self.check_row_for_win(line):
+        sign = board.cell(x, y)
+        if sign == NOBODY:
+            return False
+        mask = board.mask(sign)
+        for window in self.windows_through_cells(board.size, self.__win_length or board.size)[y * board.size + x]:
+            if mask & window == window:
                 return True
         return False
 
@@ -93,7 +167,7 @@ class Rules(object):
         :return:
         """
         starter = row[0]
-        if starter is None:
+        if starter == NOBODY:
             return False
         for cell in row:
             if cell != starter:
@@ -102,15 +176,23 @@ class Rules(object):
 
 
 class Game(object):
+    """
+    Moves, last move and winner are settings.CROSS/CIRCLE, mask takes sign code
+    """
     GAME = 0
     WIN = 1
     TIE = 2
-
-    def __init__(self):
-        self.__board = Field(3)
-        self.__rules = Rules()
-        self.__last_move = CIRCLE
-        self.__win_by = None
+    __slots__ = ('__board', '__rules', '__win_length', '__table', '__last_move', '__win_by', '__state')
+
+    def __init__(self, size=3, win_length=None):
+        self.__board = Field(size)
+        self.__rules = Rules(win_length)
+        self.__win_length = win_length or size
+        self.__table = None
+        if size == table.SIZE and self.__win_length == table.SIZE:
+            self.__table = table.position_table
+        self.__last_move = O
+        self.__win_by = NOBODY
         self.__state = self.GAME
 
     @property
@@ -119,7 +201,30 @@ class Game(object):
 
     @property
     def last_move(self):
-        return self.__last_move
+        return SIGNS[self.__last_move]
+
+    @property
+    def size(self):
+        return self.__board.size
+
+    def mask(self, sign):
+        """
+        :param sign: X or O
+        """
+        return self.__board.mask(sign)
+
+    @property
+    def table(self):
+        """precomputed position table if there is one for this board
+
+        :return:
+        :rtype: table.PositionTable
+        """
+        return self.__table
+
+    @property
+    def win_length(self):
+        return self.__win_length
 
     def place_cross(self, x, y):
         return self.make_move(CROSS, x, y)
@@ -135,7 +240,8 @@ class Game(object):
         :param y:
         :return:
         """
-        if sign not in [CROSS, CIRCLE]:
+        sign = SIGN_CODES.get(sign, NOBODY)
+        if sign == NOBODY:
             return False
         if self.__last_move == sign:
             return False
@@ -144,7 +250,12 @@ class Game(object):
         outcome = self.__board.put_sign(sign, x, y)
         if not outcome:
             return False
-        if self.__rules.check_win_from_move(self.__board, x, y):
+        if self.__table is not None:
+            outcome = self.__table.outcome(self.__board.mask(X), self.__board.mask(O))
+            won = outcome == table.CROSS_WIN or outcome == table.CIRCLE_WIN
+        else:
+            won = self.__rules.check_win_from_move(self.__board, x, y)
+        if won:
             self.__win_by = sign
             self.__state = self.WIN
         elif self.__board.is_full:
@@ -158,14 +269,14 @@ class Game(object):
 
     @property
     def winner(self):
-        return self.__win_by
+        return SIGNS[self.__win_by]
 
 
 class GameAI(User):
-    SIZE = 3
     name = 'AI'
     stats = [0, 0, 0]
     user_id = 'AI'
+    rating = RATING_START
 
     @property
     def wins(self):
@@ -191,16 +302,91 @@ class GameAI(User):
     def loses(self, value):
         pass
 
-    def __init__(self, controller):
+    __engines = {}
+
+    def __init__(self, controller, game, level=AI_LEVEL, pool=None):
+        """
+        :param controller: callable making move for AI
+        :param game: game AI plays in, AI always plays circle
+        :type game: Game
+        :param level: difficulty, one of settings.AI_LEVELS
+        :param pool: process pool searching moves, see aipool.AIPool. Without it AI searches in reactor thread
+        """
+        self.invalidate()
         self.__controller = controller
+        self.__game = game
+        self.__depth = AI_LEVELS[level]
+        self.__pool = pool
+        self.__search = None
+
+    @classmethod
+    def engine(cls, size, win_length):
+        """engines are shared by all games of the same board, so is their transposition table
+
+        :param size:
+        :param win_length:
+        :return:
+        :rtype: Engine
+        """
+        key = (size, win_length)
+        if key not in cls.__engines:
+            cls.__engines[key] = Engine(size, win_length, Rules.windows_through_cells(size, win_length),
+                                        AI_TABLE_SIZE)
+        return cls.__engines[key]
 
     def play(self):
-        """just randomly tries to make move until gets True
+        """asks engine for the best move it can find in time and makes it.
+        Perfect play on board with position table is single lookup
+
+        :return:
+        """
+        started = metrics.clock() if metrics.enabled else None
+        cross, circle = self.__game.mask(X), self.__game.mask(O)
+        positions = self.__game.table
+        if positions is not None and self.__depth >= self.__game.size ** 2:
+            x, y = positions.best_move(cross, circle, CIRCLE)
+            search = 'table'
+        elif self.__pool is not None:
+            self.__search = self.__pool.best_move(self.__game.size, self.__game.win_length, circle, cross,
+                                                  self.__depth, AI_MOVE_TIME)
+            self.__search.addErrback(self.search_failed, circle, cross)
+            self.__search.addCallback(self.found, started)
+            return self.__search
+        else:
+            engine = self.engine(self.__game.size, self.__game.win_length)
+            x, y = engine.best_move(circle, cross, self.__depth, AI_MOVE_TIME)
+            search = 'local'
+        if started is not None:
+            metrics.since(started, 'ai_move_seconds', search=search)
+        return self.__controller('AI', x, y)
+
+    def search_failed(self, failure, circle, cross):
+        """searches in reactor thread if pool failed, cancelled search stays cancelled
+
+        :param failure:
+        :param circle:
+        :param cross:
+        :return:
+        """
+        if failure.check(CancelledError):
+            return failure
+        log.err(failure, 'AI search in pool failed')
+        engine = self.engine(self.__game.size, self.__game.win_length)
+        return engine.best_move(circle, cross, self.__depth, AI_MOVE_TIME)
+
+    def found(self, move, started=None):
+        self.__search = None
+        if started is not None:
+            metrics.since(started, 'ai_move_seconds', search='pool')
+        x, y = move
+        return self.__controller('AI', x, y)
+
+    def cancel(self):
+        """forgets search in progress, its move won't be made
 
         :return:
         """
-        result = False
-        while not result:
-            x = randint(0, 2)
-            y = randint(0, 2)
-            result = self.__controller('AI', x, y)
+        search, self.__search = self.__search, None
+        if search is not None:
+            search.addErrback(lambda failure: failure.trap(CancelledError))
+            search.cancel()
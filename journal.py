@@ -0,0 +1,74 @@
+import os
+from pickle import HIGHEST_PROTOCOL, dumps, load, loads
+from struct import Struct
+from zlib import crc32
+
+RECORD_HEADER = Struct('>II')  # payload length, payload crc32
+
+
+class Journal(object):
+    """
+    Pickle snapshot with log of changed users of older versions, read once to import users into store (see
+    user.UserManager.load_users and migrate.py). Its record format is kept by store.FileStore data files
+
+    Each record holds full pickled user, not a difference, so replaying same record twice gives same result.
+    Torn record at the end of the log (process died in the middle of write) fails length or checksum test and
+    is cut off on load
+    """
+
+    def __init__(self, snapshot_file, log_file):
+        self.__snapshot_file = snapshot_file
+        self.__log_file = log_file
+
+    def load(self):
+        """Loads snapshot and replays log over it
+
+        :return: users by user_id
+        :rtype: dict
+        """
+        users = {}
+        if os.path.exists(self.__snapshot_file) and os.path.getsize(self.__snapshot_file) > 0:
+            with open(self.__snapshot_file, 'rb') as fp:
+                try:
+                    users.update(load(fp))
+                except (ValueError, EOFError):
+                    pass
+        if os.path.exists(self.__log_file):
+            good_offset = 0
+            with open(self.__log_file, 'rb') as fp:
+                for user_id, user in self.read_records(fp):
+                    users[user_id] = user
+                    good_offset = fp.tell()
+            if good_offset != os.path.getsize(self.__log_file):
+                with open(self.__log_file, 'r+b') as fp:
+                    fp.truncate(good_offset)
+        return users
+
+    @staticmethod
+    def read_records(fp):
+        """yields (user_id, user) pairs from log until end of file or first broken record
+
+        :param fp:
+        :return:
+        """
+        while True:
+            header = fp.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = fp.read(length)
+            if len(payload) < length or crc32(payload) & 0xffffffff != checksum:
+                return
+            yield loads(payload)
+
+    @staticmethod
+    def encode(user_id, user):
+        """serializes user into log record
+
+        :param user_id:
+        :param user:
+        :return:
+        :rtype: bytes
+        """
+        payload = dumps((user_id, user), HIGHEST_PROTOCOL)
+        return RECORD_HEADER.pack(len(payload), crc32(payload) & 0xffffffff) + payload
@@ -1,47 +1,59 @@
-from collections import deque
-from json import dumps, loads
+import socket
+from argparse import SUPPRESS, ArgumentParser
+from functools import partial
+from operator import attrgetter
+from itertools import count
 from time import time
 
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred
 from twisted.internet.protocol import ServerFactory, connectionDone
-from twisted.protocols.basic import LineReceiver
-from voluptuous import ExactSequence, Schema, MultipleInvalid
 
+import admin
+import aipool
+import cluster
+import metrics
+import profiler
 import settings
+import table
+import timers
+from encoding import SharedState
+from framing import FRAMINGS, FramedReceiver
 from game import Game, GameAI
-from user import user_mananger
+from matchmaking import MatchQueue, RatingPolicy
+from user import elo, user_mananger
+from validation import VALIDATORS, validate
 
 users = {}
 user_protocols = {}
+DEFAULT_VARIANT = (settings.BOARD_SIZE, settings.BOARD_SIZE)
+PINGS = dict((name, framing.encode({'cmd': 'ping'})) for name, framing in FRAMINGS.items())
 
 
-class CQueue(deque):
-    """
-    Just a queue which is a little bit easier to use for me
-    """
-    def push(self, value):
-        self.appendleft(value)
-
-    def isEmpty(self):
-        return len(self) == 0
-
-
-class TTTServer(LineReceiver):
+class TTTServer(FramedReceiver):
+    MAX_LENGTH = settings.MAX_LINE_LENGTH
     GAME_STATE_IDLE = 0
     GAME_STATE_QUEUE = 1
     GAME_STATE_PLAYING = 2
 
     def __init__(self):
         self.__kill_flag = False
+        self.__closed = False
         self.authorized = False
         self.__updated = time()
         self.__game_state = None
-        self.__game_state_data = None
+        self.__shared_state = None
+        self.__your_type = None
         self.user = None
-        self.death_timer = None
+        self.ai_level = settings.AI_LEVEL
+        self.delta = False
+        self.__framing_requested = self.framing.name
+        self.__missed_pings = 0
+        self.__heartbeat_timer = (self, 'heartbeat')
+        self.__auth_timer = (self, 'auth')
 
     def connectionMade(self):
-        pass
+        timers.wheel.schedule(self.__auth_timer, settings.AUTH_TIMEOUT, self.transport.loseConnection)
 
     def connectionLost(self, reason=connectionDone):
         """removes user from game manager on disconnect and from user_manager
@@ -49,26 +61,16 @@ class TTTServer(LineReceiver):
         :param reason:
         :return:
         """
+        self.__closed = True
+        self.stop_death_timer()
+        timers.wheel.cancel(self.__heartbeat_timer)
+        timers.wheel.cancel(self.__auth_timer)
         if self.__game_state in [self.GAME_STATE_PLAYING, self.GAME_STATE_QUEUE]:
             game_manager.drop_player(self.user.user_id)
-        if self.authorized:
+        if self.authorized and user_mananger.protocols.get(self.user.user_id) is self:
             user_mananger.remove_user(self.user.user_id)
             user_mananger.protocols.pop(self.user.user_id)
 
-    @staticmethod
-    def packet_prepare(raw_data):
-        """Basic processing for incoming lines: json decoding
-
-        :param raw_data:
-        :return:
-        """
-        try:
-            data = raw_data
-            data_object = loads(data)
-        except Exception as e:
-            return False
-        return data_object
-
     def send_error(self, kill=False):
         """Send generic error message and drop connection if needed
 
@@ -78,17 +80,61 @@ class TTTServer(LineReceiver):
         self.__kill_flag = kill
         self.responder({"state": "error"})
 
-    def lineReceived(self, line):
-        """Event that is called when full line received
+    def lineLengthExceeded(self, line):
+        """Drops client sending line longer than any valid command, before it is decoded
 
         :param line:
         :return:
         """
-        data = self.packet_prepare(line)
+        self.send_error(True)
+
+    def packetReceived(self, data):
+        """Event that is called when full command received, in whatever framing client uses
+
+        :param data: decoded command
+        :return:
+        """
         if data is False or not isinstance(data, dict):
             return self.send_error(True)
+        if self.authorized:
+            self.alive()
+        if data.get('cmd') == 'pong':
+            return
         self.proto_reactor(data)
 
+    def alive(self):
+        """Client sent something, so it's alive: next ping only after HEARTBEAT_INTERVAL of silence
+
+        :return:
+        """
+        self.__missed_pings = 0
+        timers.wheel.schedule(self.__heartbeat_timer, settings.HEARTBEAT_INTERVAL, self.heartbeat)
+
+    def heartbeat(self):
+        """Pings silent client, drops it after HEARTBEAT_MISSES unanswered pings. Pings aren't counted while
+        reading from clients is paused by backpressure
+
+        :return:
+        """
+        if not user_mananger.paused:
+            self.__missed_pings += 1
+        if self.__missed_pings > settings.HEARTBEAT_MISSES:
+            return self.transport.loseConnection()
+        self.send_encoded(PINGS[self.framing.name])
+        timers.wheel.schedule(self.__heartbeat_timer, settings.HEARTBEAT_INTERVAL, self.heartbeat)
+
+    def authorized_as(self, user):
+        """switches connection to authorized state
+
+        :param user:
+        :return:
+        """
+        self.authorized = True
+        self.__game_state = self.GAME_STATE_IDLE
+        self.user = user
+        timers.wheel.cancel(self.__auth_timer)
+        self.alive()
+
     def proto_reactor(self, packet):
         """Generic message reactor. It'll redirect message to more specific one depending on client state
 
@@ -96,20 +142,32 @@ class TTTServer(LineReceiver):
         :return:
         """
         command = packet.get('cmd', None)
+        if not metrics.enabled:
+            return self.dispatch(command, packet)
+        started = metrics.clock()
+        self.dispatch(command, packet)
+        metrics.since(started, 'command_seconds', command=command if command in VALIDATORS else 'unknown')
+
+    def dispatch(self, command, packet):
         if self.authorized:
             self.game_reactor(command, packet)
         else:
             self.auth_reactor(command, packet)
 
-    def start_game(self, state):
-        """called by GameManager instance, changes state of client and sends him starting state of game
+    def start_game(self, shared_state, your_type):
+        """called by GameManager instance, changes state of client and sends him starting state of game.
+        Connection keeps the state and applies deltas to it, so full snapshot can be sent at any time
 
-        :param state:
+        :param shared_state: state of the game, shared with the other player if he is connected to this process
+        :type shared_state: SharedState
+        :param your_type: sign of this player
         :return:
         """
         if self.__game_state == self.GAME_STATE_QUEUE and self.authorized:
             self.__game_state = self.GAME_STATE_PLAYING
-            self.responder(state)
+            self.__shared_state = shared_state
+            self.__your_type = your_type
+            self.send_game_state()
 
     def game_reactor(self, command, packet):
         """Reacts on command in authorized state: queueing for game or playing it
@@ -120,58 +178,70 @@ class TTTServer(LineReceiver):
         """
         if self.__game_state == self.GAME_STATE_IDLE:
             if command == 'queue':
+                variant = self.check_variant(packet)
+                if variant is False:
+                    return self.cmd_state(command, False)
+                self.ai_level = packet.get('level', settings.AI_LEVEL)
                 self.__game_state = self.GAME_STATE_QUEUE
                 self.cmd_state(command, True)
-                game_manager.queue_user(self.user)
+                game_manager.queue_user(self.user, variant)
         elif self.__game_state == self.GAME_STATE_QUEUE:
             pass
         elif self.__game_state == self.GAME_STATE_PLAYING:
+            if command == 'state':
+                return self.send_game_state()
             if command == 'move':
                 self.reset_death_timer()
-                schema = ExactSequence([int, int])
-                raw_pos = packet.get('pos')
-                position = self.check_data(raw_pos, schema)
+                position = validate(command, packet)
                 if position is False:
-                    return self.responder(self.__game_state_data)
-                if not game_manager.make_move(self.user.user_id, *position):
-                    return self.responder(self.__game_state_data)
-                return self.cmd_state(command, True)
+                    return self.send_game_state()
+                result = game_manager.make_move(self.user.user_id, *position)
+                if isinstance(result, Deferred):
+                    return result.addCallback(self.move_done, command)
+                return self.move_done(result, command)
         else:
             self.send_error()
 
+    def move_done(self, success, command):
+        """Confirms accepted move or resends current game state if move was rejected
+
+        :param success:
+        :param command:
+        :return:
+        """
+        if not success:
+            return self.send_game_state()
+        return self.cmd_state(command, True)
+
     def reset_death_timer(self):
         """resets or sets death time which will disconnect user if he becomes inactive
 
         :return:
         """
-        if self.death_timer:
-            self.death_timer.cancel()
-            self.death_timer = None
-        self.death_timer = reactor.callLater(settings.GAME_TIMEOUT, self.transport.loseConnection)
+        timers.wheel.schedule(self, settings.GAME_TIMEOUT, self.transport.loseConnection)
 
     def stop_death_timer(self):
         """stops disconnection timer for non-ingame states
 
         :return:
         """
-        if self.death_timer and self.death_timer.called != 1:
-            self.death_timer.cancel()
-            self.death_timer = None
+        timers.wheel.cancel(self)
 
     @staticmethod
-    def check_data(data, schema):
-        """check if data received have structure and data needed
+    def check_variant(packet):
+        """gets requested board size and win length from queue command, both are optional
 
-        :param data:
-        :param schema:
-        :return:
+        :param packet:
+        :return: (size, win_length) or False if variant is not supported
         """
-        validator = Schema(schema, True)
-        try:
-            validator(data)
-        except MultipleInvalid as e:
+        variant = validate('queue', packet)
+        if variant is False:
             return False
-        return data
+        size = variant.get('size', settings.BOARD_SIZE)
+        win_length = variant.get('win', size)
+        if win_length > size:
+            return False
+        return size, win_length
 
     def cmd_state(self, cmd, ok=False):
         """Prepares and sends simple response to command
@@ -190,46 +260,120 @@ class TTTServer(LineReceiver):
         :param packet:
         :return:
         """
+        packet = validate(command, packet)
+        if packet is False or command not in ('auth', 'reg'):
+            return self.send_error(True)
+        self.delta = packet.get('delta', False)
+        self.__framing_requested = packet.get('framing', self.framing.name)
         if command == 'auth':
-            user_id = packet.get('user_id')
-            result = user_mananger.auth_user(user_id, self)
-            answer = {'cmd': command, 'success': False, "stats": user_mananger.get_user_stats(user_id)}
-            if result:
-                self.authorized = True
-                self.__game_state = self.GAME_STATE_IDLE
-                self.user = result
-                answer['success'] = True
-            self.responder(answer)
+            d = maybeDeferred(user_mananger.auth_user, packet.get('user_id'), self)
+            d.addCallback(self.auth_done, command)
         elif command == 'reg':
-            user = user_mananger.register_new_user(self)
-            result = {'cmd': 'reg', 'success': True, 'user_id': user.user_id}
-            self.authorized = True
-            self.__game_state = self.GAME_STATE_IDLE
-            self.user = user
-            self.responder(result)
+            d = maybeDeferred(user_mananger.register_new_user, self)
+            d.addCallback(self.reg_done)
         else:
             self.send_error(True)
 
+    @property
+    def closing(self):
+        """connection is lost or being closed"""
+        return self.__closed or self.transport.disconnecting
+
+    def login_abandoned(self, user):
+        """Logs user out if client left while login was in progress (it takes a round trip to coordinator in
+        worker mode), connectionLost didn't do it as the connection wasn't authorized yet
+
+        :param user:
+        :return: True if connection is closing
+        """
+        if not self.closing:
+            return False
+        if user and user_mananger.protocols.get(user.user_id) is self:
+            user_mananger.remove_user(user.user_id)
+            user_mananger.protocols.pop(user.user_id)
+        return True
+
+    def auth_done(self, user, command):
+        """Answers auth command once user manager has checked user (immediately or via coordinator process)
+
+        :param user:
+        :param command:
+        :return:
+        """
+        if self.login_abandoned(user):
+            return
+        answer = {'cmd': command, 'success': False, "stats": False, "rating": None, "delta": self.delta,
+                  "framing": self.framing.name}
+        if user:
+            self.authorized_as(user)
+            answer['success'] = True
+            answer['stats'] = user.stats
+            answer['rating'] = int(round(user.rating))
+            answer['framing'] = self.__framing_requested
+        self.responder(answer)
+        if user:
+            self.switch_framing(self.__framing_requested)
+
+    def reg_done(self, user):
+        """Answers reg command with id of newly created user
+
+        :param user:
+        :return:
+        """
+        if self.login_abandoned(user):
+            return
+        result = {'cmd': 'reg', 'success': True, 'user_id': user.user_id, 'delta': self.delta,
+                  'framing': self.__framing_requested}
+        self.authorized_as(user)
+        self.responder(result)
+        self.switch_framing(self.__framing_requested)
+
     def responder(self, data):
         """prepares command object to send it to the client killing connection if needed
 
         :param data:
         :return:
         """
-        packet = dumps(data).encode()
-        self.sendLine(packet)
+        self.send_encoded(self.framing.encode(data))
+
+    def send_encoded(self, payload):
+        """sends command object already encoded by connection framing, so it can be encoded once for many clients
+
+        :param payload:
+        :return:
+        """
+        self.send_payload(payload)
         if self.__kill_flag:
             self.transport.loseConnection()
 
-    def send_game_update(self, data):
-        """Sends update of game state to the client
+    def send_game_state(self):
+        """Sends full state of current game
 
-        :param data:
         :return:
         """
+        self.send_encoded(self.framing.from_json(self.__shared_state.encoded(self.__your_type)))
+
+    def send_game_delta(self, delta, encoded=None):
+        """Applies change to game state. Sends the change itself if client negotiated delta updates at auth,
+        otherwise the whole updated state
+
+        :param delta: see GameSession.delta
+        :param encoded: delta encoded for all recipients by framing name, filled by the first recipient using framing
+        :type encoded: dict
+        :return:
+        """
+        if self.__game_state != self.GAME_STATE_PLAYING or self.__shared_state is None:
+            return
         self.reset_death_timer()
-        self.__game_state_data = data
-        self.responder(data)
+        self.__shared_state.apply(delta)
+        if not self.delta:
+            return self.send_game_state()
+        if encoded is None:
+            encoded = {}
+        payload = encoded.get(self.framing.name)
+        if payload is None:
+            payload = encoded[self.framing.name] = self.framing.encode(delta)
+        self.send_encoded(payload)
 
     def end_game(self):
         """stops disconnection timer and changes client state to 'idle"
@@ -240,154 +384,300 @@ class TTTServer(LineReceiver):
         self.__game_state = self.GAME_STATE_IDLE
 
 
+class GameSession(object):
+    """
+    Single match between two players: game object, players by sign and reverse index of signs by user id
+    """
+    def __init__(self, game_id, game, cross, circle, variant):
+        self.game_id = game_id
+        self.variant = variant
+        self.game = game
+        self.players = {settings.CROSS: cross, settings.CIRCLE: circle}
+        self.signs = {cross.user_id: settings.CROSS, circle.user_id: settings.CIRCLE}
+        self.seq = 0
+        self.ai_task = None
+
+    def cancel_ai_move(self):
+        """stops pending AI move, so it won't be played on finished game
+
+        :return:
+        """
+        if self.ai_task and self.ai_task.active():
+            self.ai_task.cancel()
+        self.ai_task = None
+        circle = self.players.get(settings.CIRCLE)
+        if isinstance(circle, GameAI):
+            circle.cancel()
+
+    @property
+    def game_state(self):
+        """forms game stat object which will be passed to clients
+
+        :return: state
+        :rtype: dict
+        """
+        game_ended = not (self.game.state == Game.GAME)
+        return_schema = {
+            "cmd": "state",
+            "field": self.game.board,
+            "player_x": self.player_info(settings.CROSS),
+            "player_o": self.player_info(settings.CIRCLE),
+            "your_type": None,
+            "win_length": self.game.win_length,
+            "last_turn": self.game.last_move,
+            "ended": game_ended,
+            "winner": self.game.winner,
+            "seq": self.seq
+        }
+        return return_schema
+
+    def player_info(self, sign):
+        return self.players[sign].header
+
+    @property
+    def headers(self):
+        """
+        :return: encoded player info by game state field, see SharedState
+        """
+        return {'player_x': self.players[settings.CROSS].header_encoded,
+                'player_o': self.players[settings.CIRCLE].header_encoded}
+
+    def delta(self, move, sign, ended=None, winner=None):
+        """forms change of game state passed to clients instead of whole state, numbered so clients can notice
+        lost ones and ask for full state
+
+        :param move: [x, y] or None if game ended without move
+        :param sign: sign of player who moved
+        :param ended: game result is taken from the game unless given
+        :param winner:
+        :return: delta
+        :rtype: dict
+        """
+        self.seq += 1
+        if ended is None:
+            ended, winner = self.game.state != Game.GAME, self.game.winner
+        return {"cmd": "delta", "move": move, "sign": sign, "seq": self.seq, "ended": ended, "winner": winner}
+
+
 class GameManager():
-    def __init__(self):
-        self.queue = CQueue()
-        self.__game = None
-        self.__players = {}
-        self.__ai_countdown_started = None
-        self.__ai_countdown_task = None
+    def __init__(self, link=None):
+        """
+        :param link: connection to coordinator process when running as one of the workers. Matchmaking and
+        games of players connected to other workers are handled through it
+        :type link: cluster.WorkerLink
+        """
+        self.queues = {}
+        self.remote_games = set()
+        self.__link = link
+        self.__queued = {}
+        self.__games = {}
+        self.__player_games = {}
+        self.__game_ids = count(1)
 
-    def queue_user(self, user):
-        """pushes user at the end of the queue and tries to start game
+    def queue_user(self, user, variant=DEFAULT_VARIANT):
+        """pushes user at the end of the queue of requested game variant and tries to start game
 
         :param user:
         :type user: User
+        :param variant: board size and win length
         :return:
         """
         # Check if there are more users and if they're not playing to start immediately
-        self.queue.push(user)
-        self.start_game()
+        if self.__link:
+            return self.__link.enqueue(user.user_id, variant)
+        if user.user_id in self.__queued:
+            return False
+        if variant not in self.queues:
+            self.queues[variant] = MatchQueue(RatingPolicy(attrgetter('rating')))
+        self.queues[variant].push(user.user_id, user)
+        self.__queued[user.user_id] = variant
+        self.start_game(variant, [user.user_id])
+
+    def create_session(self, cross, circle=None, variant=DEFAULT_VARIANT):
+        """registers new game session and indexes its human players. Without circle player AI takes its place,
+        playing on difficulty level cross player asked for
+
+        :param cross:
+        :param circle:
+        :param variant:
+        :return:
+        :rtype: GameSession
+        """
+        game_id = next(self.__game_ids)
+        game = Game(*variant)
+        if circle is None:
+            circle = GameAI(partial(self.make_move, game_id=game_id), game, cross.protocol.ai_level,
+                            aipool.ai_pool)
+        session = GameSession(game_id, game, cross, circle, variant)
+        self.__games[session.game_id] = session
+        for player in session.players.values():
+            if not isinstance(player, GameAI):
+                self.__player_games[player.user_id] = session.game_id
+        return session
+
+    @property
+    def active_games(self):
+        return len(self.__games)
+
+    def get_session(self, user_id):
+        """finds game session user is playing in
+
+        :param user_id:
+        :return:
+        :rtype: GameSession
+        """
+        return self.__games.get(self.__player_games.get(user_id))
 
-    def start_game(self):
-        """Tries to start game by checking queue. If there is only one player and no game - start AI countdown
+    def start_game(self, variant, user_ids=None):
+        """Pairs players queued for variant as queue pairing policy decides.
+        If someone is left unpaired - start matchmaking timer
 
+        :param variant:
+        :param user_ids: players to find partners for, everyone queued by default
         :return:
         """
-        if self.__game or self.queue.isEmpty():
+        queue = self.queues.get(variant)
+        if not queue:
             return False
-        if len(self.queue) > 1:
-            self.cancel_ai_timer()
-            self.__players = {settings.CROSS: self.queue.pop(), settings.CIRCLE: self.queue.pop()}
-            self.__game = Game()
-            game_state = self.game_state
-            for player_sign in self.__players:
-                game_state['your_type'] = player_sign
-                self.__players[player_sign].protocol.start_game(game_state)
-        elif len(self.queue) and not self.__game:
-            self.start_ai_timer()
+        for cross, circle in queue.match(user_ids):
+            self.__queued.pop(cross.user_id, None)
+            self.__queued.pop(circle.user_id, None)
+            self.begin_session(self.create_session(cross, circle, variant))
+        if len(queue) and ('queue', variant) not in timers.wheel:
+            self.start_match_timer(variant)
+
+    def match_tick(self, variant):
+        """Matches queue again as rating windows of waiting players widen. Players who waited for WAIT_TIMEOUT and
+        still have no partner in their window play AI
+
+        :param variant:
+        :return:
+        """
+        self.start_game(variant)
+        self.start_ai_game(variant)
+
+    def begin_session(self, session):
+        """sends starting state of the game to its human players
+
+        :param session:
+        :type session: GameSession
+        :return:
+        """
+        shared_state = SharedState(session.game_state, session.headers)
+        for player_sign, player in session.players.iteritems():
+            if not isinstance(player, GameAI):
+                player.protocol.start_game(shared_state, player_sign)
 
-    def start_ai_timer(self):
-        """Creates timed call for AI game start
+    def start_match_timer(self, variant):
+        """Creates timed call of next matchmaking round
 
+        :param variant:
         :return:
         """
-        self.__ai_countdown_started = time()
-        self.__ai_countdown_task = reactor.callLater(settings.WAIT_TIMEOUT, self.start_ai_game)
+        timers.wheel.schedule(('queue', variant), settings.MATCH_TICK, partial(self.match_tick, variant))
 
-    def cancel_ai_timer(self):
-        """stops timer that will start match with AI
+    def cancel_match_timer(self, variant):
+        """stops matchmaking rounds of empty queue
 
+        :param variant:
         :return:
         """
-        if self.__ai_countdown_task:
-            self.__ai_countdown_started = None
-            self.__ai_countdown_task.cancel()
-            self.__ai_countdown_task = None
+        timers.wheel.cancel(('queue', variant))
 
-    def make_move(self, user_id, x, y):
-        for sign, player in self.__players.iteritems():
-            if user_id == player.user_id:
-                if self.__game.make_move(sign, x, y):
-                    new_state = self.game_state
-                    new_state['your_type'] = sign
-                    self.broadcast_update(new_state)
-                    return True
-        return False
+    def make_move(self, user_id, x, y, game_id=None):
+        """makes move in the game user is playing. AI players don't have index entry so they pass their game id
 
-    def broadcast_update(self, state):
+        :param user_id:
+        :param x:
+        :param y:
+        :param game_id:
+        :return:
+        """
+        if user_id in self.remote_games:
+            return self.__link.remote_move(user_id, x, y)
+        if game_id is None:
+            game_id = self.__player_games.get(user_id)
+        session = self.__games.get(game_id)
+        if not session:
+            return False
+        sign = session.signs.get(user_id)
+        if sign is None or not session.game.make_move(sign, x, y):
+            return False
+        self.broadcast_update(session, session.delta([x, y], sign))
+        return True
+
+    def broadcast_update(self, session, delta):
         """checks update from game, send it to players if game is ended -> update player stats and calls endgame
 
-        :param state: game state
-        :type state: dict
+        :param session:
+        :type session: GameSession
+        :param delta: change of game state, the same for both players
+        :type delta: dict
         :return:
         """
         # Check what this update means (i.e. win, lose, tie)
         # If endgame -> drop players, Update stats for player
         # if AI -> defer move call
 
-        if self.__game.last_move == settings.CROSS \
-                and isinstance(self.__players[settings.CIRCLE], GameAI) \
-                and self.__game.state == Game.GAME:
-            reactor.callLater(1, self.__players[settings.CIRCLE].play)
-        for sign, player in self.__players.iteritems():
+        if session.game.last_move == settings.CROSS \
+                and isinstance(session.players[settings.CIRCLE], GameAI) \
+                and session.game.state == Game.GAME:
+            session.ai_task = reactor.callLater(1, session.players[settings.CIRCLE].play)
+        encoded = {}
+        for player in session.players.values():
             if not isinstance(player, GameAI):
-                state['your_type'] = sign
-                player.protocol.send_game_update(state)
-        if self.__game.state != Game.GAME:
-            self.update_stats(self.__game.winner)
-            self.endgame()
+                player.protocol.send_game_delta(delta, encoded)
+        if session.game.state != Game.GAME:
+            self.update_stats(session, session.game.winner)
+            self.endgame(session)
 
-    def update_stats(self, winner):
-        """update players statistics when game ends
+    def update_stats(self, session, winner):
+        """update players statistics when game ends. Both players are saved in the same batch of user manager,
+        so their changes are written together (in one transaction with SQLite store)
 
+        :param session:
         :param winner:
         :return:
         """
+        players = session.players
         if winner is None:
-            for player in self.__players.values():
+            for player in players.values():
                 player.ties += 1
         elif winner == settings.CIRCLE:
-            self.__players[settings.CIRCLE].wins += 1
-            self.__players[settings.CROSS].loses += 1
+            players[settings.CIRCLE].wins += 1
+            players[settings.CROSS].loses += 1
         else:
-            self.__players[settings.CIRCLE].loses += 1
-            self.__players[settings.CROSS].wins += 1
-        user_mananger.save_users()
+            players[settings.CIRCLE].loses += 1
+            players[settings.CROSS].wins += 1
+        cross, circle = players[settings.CROSS], players[settings.CIRCLE]
+        if not isinstance(circle, GameAI):
+            score = {None: 0.5, settings.CROSS: 1, settings.CIRCLE: 0}[winner]
+            cross.rating, circle.rating = elo(cross.rating, circle.rating, score), \
+                elo(circle.rating, cross.rating, 1 - score)
+        for player in players.values():
+            if not isinstance(player, GameAI):
+                user_mananger.save_user(player)
 
-    def endgame(self):
-        """endgame event, updates player state, resets game manager game object and players list
+    def endgame(self, session):
+        """endgame event, updates player state, removes game session and its players from index
         """
-        for player in self.__players.values():
+        session.cancel_ai_move()
+        for player in session.players.values():
             if not isinstance(player, GameAI):
                 player.protocol.end_game()
-        self.__players = {}
-        self.__game = None
-        self.start_game()
+                self.__player_games.pop(player.user_id, None)
+        self.__games.pop(session.game_id, None)
+        self.start_game(session.variant)
 
-    def start_ai_game(self):
-        """Starts match with AI
+    def start_ai_game(self, variant):
+        """Starts matches with AI for players waiting for WAIT_TIMEOUT or longer
 
+        :param variant:
         :return:
         """
-        if not self.__game and len(self.queue) == 1:
-            self.__players = {settings.CROSS: self.queue.pop(), settings.CIRCLE: GameAI(self.make_move)}
-            self.__game = Game()
-            game_state = self.game_state
-            game_state['your_type'] = settings.CROSS
-            self.__players[settings.CROSS].protocol.start_game(game_state)
-
-    @property
-    def game_state(self):
-        """forms game stat object which will be passed to clients
-
-        :return: state
-        :rtype: dict
-        """
-        if not self.__game:
-            return False
-        game_ended = not (self.__game.state == Game.GAME)
-        return_schema = {
-            "cmd": "state",
-            "field": self.__game.board,
-            "player_x": {"name": self.__players[settings.CROSS].name, "stats": self.__players[settings.CROSS].stats},
-            "player_o": {"name": self.__players[settings.CIRCLE].name, "stats": self.__players[settings.CIRCLE].stats},
-            "your_type": None,
-            "last_turn": self.__game.last_move,
-            "ended": game_ended,
-            "winner": self.__game.winner
-        }
-        return return_schema
+        for user in self.queues[variant].overdue(settings.WAIT_TIMEOUT):
+            self.__queued.pop(user.user_id, None)
+            self.begin_session(self.create_session(user, variant=variant))
 
     def drop_player(self, user_id):
         """drops player from GameManager, resulting in other player win if in game
@@ -399,34 +689,78 @@ class GameManager():
         user = user_mananger.users.get(user_id)
         if not user:
             return False
-        if user in self.queue:
-            self.queue.remove(user)
+        if self.__link:
+            if user_id in self.remote_games:
+                self.remote_games.discard(user_id)
+                return self.__link.remote_drop(user_id)
+            if not self.get_session(user_id):
+                return self.__link.dequeue(user_id)
+        variant = self.__queued.pop(user_id, None)
+        if variant is not None:
+            queue = self.queues[variant]
+            queue.remove(user_id)
+            if queue.isEmpty():
+                self.cancel_match_timer(variant)
         else:
-            playing = False
-            loses = None
-            for sign, player in self.__players.iteritems():
-                if user_id == player.user_id:
-                    playing = True
-                    loses = sign
-            if playing:
+            session = self.get_session(user_id)
+            if session:
                 winner = settings.CROSS
-                if loses == settings.CROSS:
+                if session.signs[user_id] == settings.CROSS:
                     winner = settings.CIRCLE
-                self.update_stats(winner)
-                if not isinstance(self.__players[winner], GameAI):
-                    state = self.game_state
-                    state['winner'] = winner
-                    state['your_type'] = winner
-                    state['ended'] = True
-                    self.__players[winner].protocol.send_game_update(state)
-                self.endgame()
+                self.update_stats(session, winner)
+                if not isinstance(session.players[winner], GameAI):
+                    session.players[winner].protocol.send_game_delta(session.delta(None, None, True, winner))
+                self.endgame(session)
+
+
+def register_gauges(matchmaking=True):
+    """gauges of this process, read when metrics are collected
+
+    :param matchmaking: players are queued in this process. Workers queue them on coordinator, which exposes
+        queue gauge itself
+    :return:
+    """
+    metrics.registry.gauge('connections', lambda: len(user_mananger.protocols))
+    metrics.registry.gauge('games', lambda: game_manager.active_games)
+    if matchmaking:
+        metrics.registry.gauge('queued_players', lambda: sum(len(queue) for queue in game_manager.queues.values()))
 
 
 if __name__ == '__main__':
-    game_manager = GameManager()
+    parser = ArgumentParser(description='Tic-tac-toe server')
+    parser.add_argument('--workers', type=int, default=settings.WORKERS,
+                        help='number of worker processes sharing the port')
+    parser.add_argument('--worker', type=int, help=SUPPRESS)
+    args = parser.parse_args()
 
     factory = ServerFactory()
     factory.protocol = TTTServer
-
-    reactor.listenTCP(8899, factory)
-    reactor.run()
+    table.load()
+
+    if args.worker is not None:
+        def linked(link):
+            global game_manager, user_mananger
+            user_mananger = cluster.install_user_manager(cluster.RemoteUserManager(link))
+            game_manager = GameManager(link)
+            link.user_manager = user_mananger
+            link.game_manager = game_manager
+            register_gauges(matchmaking=False)
+            reactor.adoptStreamPort(cluster.LISTENER_FD, socket.AF_INET, factory)
+        aipool.start()
+        cluster.connect_worker().addCallback(linked)
+        if settings.ADMIN_PORT:
+            admin.start(settings.ADMIN_PORT + 1 + args.worker)
+        profiler.install_signal()
+        reactor.run()
+    elif args.workers > 1:
+        cluster.run_supervisor(args.workers, settings.PORT)
+    else:
+        game_manager = GameManager()
+        user_mananger.load_users()
+        aipool.start()
+        register_gauges()
+        admin.start(settings.ADMIN_PORT)
+        profiler.install_signal()
+        reactor.listenTCP(settings.PORT, factory)
+        reactor.addSystemEventTrigger('before', 'shutdown', user_mananger.save_users)
+        reactor.run()
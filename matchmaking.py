@@ -0,0 +1,205 @@
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+import metrics
+import settings
+
+
+class FIFOPolicy(object):
+    """
+    Pairing policy: decides who of queued players plays with whom. Queue tells policy about every added and removed
+    player, so policy can keep own index of them. This one pairs players in order they queued
+    """
+
+    def added(self, queue, key, item):
+        pass
+
+    def removed(self, queue, key):
+        pass
+
+    def pairs(self, queue, keys):
+        """
+        :param queue:
+        :type queue: MatchQueue
+        :param keys: players to find partners for, in order they queued
+        :return: list of pairs of keys, first one plays cross
+        """
+        pairs = []
+        paired = set()
+        for key in keys:
+            if key in paired:
+                continue
+            for candidate in queue:
+                if candidate != key and candidate not in paired:
+                    paired.update((key, candidate))
+                    pairs.append(tuple(sorted((key, candidate), key=queue.enqueued_at)))
+                    break
+        return pairs
+
+
+class RatingPolicy(FIFOPolicy):
+    """
+    Pairs players of close rating. Players are indexed by rating bucket, player looks for partner in own bucket
+    first, then in neighbouring ones: one more bucket on each side for every widen_every seconds of waiting.
+    Within the bucket the longest waiting partner wins. Cost of search depends on window, not on queue length
+    """
+
+    def __init__(self, rating, bucket_width=settings.RATING_BUCKET, widen_every=settings.RATING_WIDEN_EVERY,
+                 max_window=settings.RATING_MAX_WINDOW):
+        """
+        :param rating: callable returning rating of queued item
+        :param bucket_width: rating points per bucket
+        :param widen_every: seconds
+        :param max_window: buckets on each side
+        """
+        self.__rating = rating
+        self.__bucket_width = bucket_width
+        self.__widen_every = widen_every
+        self.__max_window = max_window
+        self.__buckets = {}
+        self.__bucket_of = {}
+
+    def added(self, queue, key, item):
+        bucket = int(self.__rating(item) // self.__bucket_width)
+        self.__bucket_of[key] = bucket
+        self.__buckets.setdefault(bucket, OrderedDict())[key] = None
+
+    def removed(self, queue, key):
+        bucket = self.__bucket_of.pop(key)
+        members = self.__buckets[bucket]
+        del members[key]
+        if not members:
+            del self.__buckets[bucket]
+
+    def window(self, queue, key):
+        """
+        :return: buckets on each side player accepts
+        """
+        return min(self.__max_window, int(queue.wait_time(key) // self.__widen_every))
+
+    def partner(self, queue, key, paired):
+        bucket = self.__bucket_of[key]
+        for distance in range(self.window(queue, key) + 1):
+            for neighbour in set((bucket - distance, bucket + distance)):
+                for candidate in self.__buckets.get(neighbour, ()):
+                    if candidate != key and candidate not in paired:
+                        return candidate
+        return None
+
+    def pairs(self, queue, keys):
+        pairs = []
+        paired = set()
+        for key in keys:
+            if key in paired:
+                continue
+            candidate = self.partner(queue, key, paired)
+            if candidate is not None:
+                paired.update((key, candidate))
+                pairs.append(tuple(sorted((key, candidate), key=queue.enqueued_at)))
+        return pairs
+
+
+class MatchQueue(object):
+    """
+    Players waiting for a game, in order they queued. Keyed by user id, so push, pop, membership and removal
+    don't depend on queue length. Who is paired with whom is decided by pairing policy
+    """
+
+    def __init__(self, policy=None, clock=None):
+        """
+        :param policy: FIFOPolicy by default, each queue needs own policy instance
+        :type policy: FIFOPolicy
+        :param clock: reactor by default
+        """
+        self.policy = policy or FIFOPolicy()
+        self.__clock = clock or reactor
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __iter__(self):
+        return iter(self.__entries)
+
+    def push(self, key, item):
+        """
+        :param key:
+        :param item:
+        :return: False if key is already queued
+        """
+        if key in self.__entries:
+            return False
+        self.__entries[key] = (item, self.__clock.seconds())
+        self.policy.added(self, key, item)
+        return True
+
+    def pop(self):
+        """
+        :return: item queued first
+        """
+        key = next(iter(self.__entries))
+        return self.remove(key)
+
+    def remove(self, key):
+        """
+        :param key:
+        :return: removed item or None if key wasn't queued
+        """
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return None
+        self.policy.removed(self, key)
+        return entry[0]
+
+    def get(self, key):
+        return self.__entries[key][0]
+
+    def enqueued_at(self, key):
+        return self.__entries[key][1]
+
+    def wait_time(self, key):
+        """
+        :param key:
+        :return: seconds key is waiting in the queue
+        """
+        return self.__clock.seconds() - self.__entries[key][1]
+
+    def isEmpty(self):
+        return not self.__entries
+
+    def match(self, keys=None):
+        """removes players paired by policy from the queue
+
+        :param keys: players to find partners for, everyone by default
+        :return: list of pairs of items
+        """
+        if keys is None:
+            keys = list(self.__entries)
+        pairs = []
+        for cross, circle in self.policy.pairs(self, keys):
+            if metrics.enabled:
+                metrics.observe('queue_wait_seconds', self.wait_time(cross), opponent='human')
+                metrics.observe('queue_wait_seconds', self.wait_time(circle), opponent='human')
+            pairs.append((self.remove(cross), self.remove(circle)))
+        return pairs
+
+    def overdue(self, timeout):
+        """removes players waiting for timeout or longer
+
+        :param timeout: seconds
+        :return: list of items
+        """
+        items = []
+        now = self.__clock.seconds()
+        while self.__entries:
+            key, (item, enqueued_at) = next(self.__entries.iteritems())
+            if now - enqueued_at < timeout:
+                break
+            if metrics.enabled:
+                metrics.observe('queue_wait_seconds', now - enqueued_at, opponent='ai')
+            items.append(self.remove(key))
+        return items
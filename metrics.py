@@ -0,0 +1,215 @@
+"""
+Server metrics kept in process memory: counters, gauges read on collection and latency histograms.
+Instrumented places check `enabled` before taking time, so disabled metrics cost one flag check
+"""
+import math
+from collections import OrderedDict
+from timeit import default_timer as clock
+
+import settings
+
+enabled = settings.METRICS
+PREFIX = 'ttt_'
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    kind = 'gauge'
+
+    def __init__(self, read):
+        """
+        :param read: callable returning current value, called on collection only
+        """
+        self.read = read
+
+    def snapshot(self):
+        return self.read()
+
+
+class Histogram(object):
+    """
+    HDR-style histogram: every power of two range is split into sub_buckets equal buckets, so quantiles are off
+    by less than 1/sub_buckets of the value while memory only depends on value range
+    """
+    kind = 'summary'
+    MIN_VALUE = 1e-7
+
+    def __init__(self, sub_buckets=16):
+        self.__sub_buckets = sub_buckets
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def bucket(self, value):
+        mantissa, exponent = math.frexp(max(value, self.MIN_VALUE))
+        return exponent * self.__sub_buckets + int((mantissa - 0.5) * 2 * self.__sub_buckets)
+
+    def upper_bound(self, bucket):
+        exponent, sub_bucket = divmod(bucket, self.__sub_buckets)
+        return math.ldexp(0.5 + (sub_bucket + 1) / (2.0 * self.__sub_buckets), exponent)
+
+    def observe(self, value):
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, quantile):
+        """
+        :param quantile: 0..1
+        :return: upper bound of bucket holding the quantile, never more than max observed value
+        """
+        if not self.count:
+            return 0.0
+        rank = quantile * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def snapshot(self):
+        result = {'count': self.count, 'sum': self.sum, 'max': self.max}
+        for quantile in QUANTILES:
+            result['p%g' % (quantile * 100)] = self.quantile(quantile)
+        return result
+
+
+class Registry(object):
+    """
+    Metrics by name and labels
+    """
+
+    def __init__(self):
+        self.__families = OrderedDict()
+
+    def metric(self, kind, name, labels, *args):
+        family = self.__families.get(name)
+        if family is None:
+            family = self.__families[name] = (kind, {})
+        key = tuple(sorted(labels.iteritems())) if len(labels) > 1 else tuple(labels.iteritems())
+        metric = family[1].get(key)
+        if metric is None:
+            metric = family[1][key] = kind(*args)
+        return metric
+
+    def counter(self, name, **labels):
+        """
+        :rtype: Counter
+        """
+        return self.metric(Counter, name, labels)
+
+    def gauge(self, name, read, **labels):
+        """registers gauge, replacing previous one with the same name and labels
+
+        :rtype: Gauge
+        """
+        gauge = self.metric(Gauge, name, labels, read)
+        gauge.read = read
+        return gauge
+
+    def histogram(self, name, **labels):
+        """
+        :rtype: Histogram
+        """
+        return self.metric(Histogram, name, labels)
+
+    def clear(self):
+        self.__families.clear()
+
+    def snapshot(self):
+        """
+        :return: {name: value} where name includes labels, like `command_seconds{command=move}`
+        """
+        result = OrderedDict()
+        for name, (kind, family) in self.__families.iteritems():
+            for labels, metric in family.iteritems():
+                if labels:
+                    name_labels = '%s{%s}' % (name, ','.join('%s=%s' % label for label in labels))
+                else:
+                    name_labels = name
+                result[name_labels] = metric.snapshot()
+        return result
+
+    def prometheus(self):
+        """
+        :return: metrics in Prometheus text exposition format, histograms are exposed as summaries
+        """
+        lines = []
+        for name, (kind, family) in self.__families.iteritems():
+            name = PREFIX + name
+            lines.append('# TYPE %s %s' % (name, kind.kind))
+            for labels, metric in family.iteritems():
+                if kind is Histogram:
+                    for quantile in QUANTILES:
+                        quantile_labels = labels + (('quantile', '%g' % quantile),)
+                        lines.append('%s%s %r' % (name, format_labels(quantile_labels), metric.quantile(quantile)))
+                    lines.append('%s_sum%s %r' % (name, format_labels(labels), metric.sum))
+                    lines.append('%s_count%s %d' % (name, format_labels(labels), metric.count))
+                else:
+                    lines.append('%s%s %r' % (name, format_labels(labels), metric.snapshot()))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+registry = Registry()
+
+
+def inc(name, amount=1, **labels):
+    registry.counter(name, **labels).inc(amount)
+
+
+def observe(name, value, **labels):
+    registry.histogram(name, **labels).observe(value)
+
+
+def since(started, name, **labels):
+    """observes time passed since started, taken from clock
+
+    :param started:
+    :param name:
+    :param labels:
+    :return:
+    """
+    registry.histogram(name, **labels).observe(clock() - started)
+
+
+def time_deferred(deferred, name, **labels):
+    """observes time until deferred fires, result is passed through
+
+    :param deferred:
+    :param name:
+    :param labels:
+    :return: the same deferred
+    """
+    if enabled:
+        started = clock()
+
+        def fired(result):
+            since(started, name, **labels)
+            return result
+        deferred.addBoth(fired)
+    return deferred
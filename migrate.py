@@ -0,0 +1,37 @@
+"""
+Copies users into store from pickle snapshot and journal of older versions or from other store. Server should be
+stopped, target store should be empty
+
+* `python migrate.py` - imports users.pickle and users.journal into store selected by STORE setting
+* `python migrate.py --source file --target sqlite` - copies users from file store into SQLite
+"""
+from argparse import ArgumentParser
+
+import settings
+from journal import Journal
+from store import copy_users
+from user import STORES
+
+LEGACY = 'pickle'
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Copies users between stores')
+    parser.add_argument('--source', default=LEGACY, choices=[LEGACY] + sorted(STORES),
+                        help='%s - %s and %s' % (LEGACY, settings.DB_FILE, settings.JOURNAL_FILE))
+    parser.add_argument('--target', default=settings.STORE, choices=sorted(STORES))
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error('source and target are the same store')
+
+    target = STORES[args.target]()
+    target.open()
+    if not target.empty:
+        parser.error('%s store already has users' % args.target)
+    if args.source == LEGACY:
+        users = Journal(settings.DB_FILE, settings.JOURNAL_FILE).load().iteritems()
+    else:
+        source = STORES[args.source]()
+        source.open()
+        users = source.items()
+    print('%s users copied into %s store' % (copy_users(users, target), args.target))
+    target.close()
@@ -0,0 +1,177 @@
+from twisted.internet import defer, reactor
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+
+import metrics
+import settings
+
+
+class GroupCommitter(object):
+    """
+    Collects changed users for a short window and writes them to the store as one batch from worker thread
+
+    Users are serialized on reactor thread, so worker never touches live objects. Only one batch is written at
+    a time, users changed meanwhile wait for the next one. When too many users are waiting for disk,
+    on_backpressure(True) is called to slow clients down, on_backpressure(False) once backlog is drained.
+    Failed batch is retried after delay doubled with every failure in a row, flush and backpressure don't
+    shorten it. Flush gives up after max_flush_retries failures in a row
+    """
+
+    def __init__(self, store, window, max_backlog, compact_every, on_backpressure=None,
+                 max_retry_delay=settings.COMMIT_MAX_RETRY_DELAY, max_flush_retries=settings.COMMIT_FLUSH_RETRIES):
+        """
+        :param store:
+        :type store: store.UserStore
+        :param window: seconds to collect changes before writing them
+        :param max_backlog: number of waiting users which triggers backpressure
+        :param compact_every: count of records appended since compaction which triggers the next one
+        :param on_backpressure:
+        :param max_retry_delay: longest delay before retry of failed batch, seconds
+        :param max_flush_retries: failures in a row after which flush fails, writes are still retried
+        """
+        self.__store = store
+        self.__window = window
+        self.__max_backlog = max_backlog
+        self.__compact_every = compact_every
+        self.__on_backpressure = on_backpressure
+        self.__max_retry_delay = max_retry_delay
+        self.__max_flush_retries = max_flush_retries
+        self.__failures = 0
+        self.__last_failure = None
+        self.__dirty = {}
+        self.__batch = None
+        self.__task = None
+        self.__writing = None
+        self.__waiters = []
+        self.__compact_requested = False
+        self.__paused = False
+
+    @property
+    def backlog(self):
+        return len(self.__dirty)
+
+    def mark_dirty(self, user):
+        """Schedules user to be written with the next batch
+
+        :param user:
+        :return:
+        """
+        self.__dirty[user.user_id] = user
+        if self.__writing is None and self.__task is None:
+            self.__task = reactor.callLater(self.__window, self.commit)
+        self.check_backpressure()
+
+    def pending(self, user_id):
+        """
+        :param user_id:
+        :return: user changed but not written yet, users are read from memory while it isn't in store
+        """
+        user = self.__dirty.get(user_id)
+        if user is None and self.__batch is not None:
+            user = self.__batch.get(user_id)
+        return user
+
+    def commit(self):
+        """Starts writing of collected users in worker thread unless other batch is being written
+
+        :return:
+        """
+        if self.__task is not None:
+            if self.__task.active():
+                self.__task.cancel()
+            self.__task = None
+        if self.__writing is not None:
+            return
+        self.__batch, self.__dirty = self.__dirty, {}
+        records = [self.__store.encode(user_id, user) for user_id, user in self.__batch.items()]
+        compact, self.__compact_requested = self.__compact_requested, False
+        self.__writing = metrics.time_deferred(deferToThread(self.write, records, compact), 'users_batch_seconds')
+        if metrics.enabled:
+            metrics.inc('users_written_total', len(records))
+        self.__writing.addCallbacks(self.write_succeeded, self.write_failed, errbackArgs=(self.__batch,))
+        self.__writing.addBoth(self.written)
+
+    def write(self, records, compact=False):
+        """runs in worker thread
+
+        :param records:
+        :param compact:
+        :return:
+        """
+        if records:
+            self.__store.append_many(records)
+        if compact or self.__store.records >= self.__compact_every:
+            self.__store.compact()
+
+    def write_succeeded(self, result):
+        self.__failures = 0
+
+    def write_failed(self, failure, batch):
+        """returns users of failed batch into backlog unless they were changed again
+
+        :param failure:
+        :param batch:
+        :return:
+        """
+        self.__failures += 1
+        self.__last_failure = failure
+        log.err(failure, 'Failed to write users batch (%s in a row)' % self.__failures)
+        for user_id, user in batch.items():
+            self.__dirty.setdefault(user_id, user)
+
+    @property
+    def retry_delay(self):
+        """
+        :return: seconds to wait before the next batch after failures, 0 if the last batch was written
+        """
+        if not self.__failures:
+            return 0
+        return min(self.__window * 2 ** self.__failures, self.__max_retry_delay)
+
+    def written(self, result):
+        """batch is on disk: start next one or wake up everyone waiting for flush
+
+        :param result:
+        :return:
+        """
+        self.__writing = self.__batch = None
+        if self.__waiters and self.__failures >= self.__max_flush_retries:
+            waiters, self.__waiters = self.__waiters, []
+            for waiter in waiters:
+                waiter.errback(self.__last_failure)
+        if self.__dirty or self.__compact_requested:
+            if self.__failures:
+                self.__task = reactor.callLater(self.retry_delay, self.commit)
+            elif self.__waiters or len(self.__dirty) >= self.__max_backlog:
+                self.commit()
+            elif self.__task is None:
+                self.__task = reactor.callLater(self.__window, self.commit)
+        elif self.__waiters:
+            waiters, self.__waiters = self.__waiters, []
+            for waiter in waiters:
+                waiter.callback(None)
+        self.check_backpressure()
+
+    def check_backpressure(self):
+        paused = len(self.__dirty) >= self.__max_backlog
+        if paused != self.__paused:
+            self.__paused = paused
+            if self.__on_backpressure:
+                self.__on_backpressure(paused)
+
+    def flush(self, compact=False):
+        """Writes everything collected so far. Should be called on shutdown
+
+        :param compact: also compact store
+        :return: deferred fired when all changes are on disk, failed with the last error if writes failed
+            max_flush_retries times in a row
+        :rtype: defer.Deferred
+        """
+        self.__compact_requested = self.__compact_requested or compact
+        if self.__writing is None and not self.__dirty and not self.__compact_requested:
+            return defer.succeed(None)
+        waiter = defer.Deferred()
+        self.__waiters.append(waiter)
+        if self.__writing is None and not self.__failures:
+            self.commit()
+        return waiter
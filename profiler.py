@@ -0,0 +1,186 @@
+"""
+On-demand profiling of running server, started from admin endpoint or by SIGUSR1. Nothing is hooked into
+interpreter until profiling window starts, so it costs nothing when off.
+
+* sample - reactor thread stack is sampled by SIGPROF timer, result is collapsed stacks file
+  (`frame;frame;frame count` lines, input of flame graph tools)
+* cprofile - cProfile for the whole window, result is pstats file
+
+Summary of each window tells share of time spent in hot server paths, see FOCUS
+"""
+import cProfile
+import os
+import pstats
+import signal
+import time
+
+from twisted.internet import reactor
+from twisted.python import log
+
+import settings
+
+SAMPLE_INTERVAL = 0.005
+MAX_SECONDS = 300
+# server paths time is attributed to: file and function names
+FOCUS = {
+    'lineReceived': (('framing.py', 'lineReceived'), ('framing.py', 'rawDataReceived')),
+    'save_users': (('user.py', 'save_users'), ('persistence.py', 'commit')),
+    'game_state': (('main.py', 'game_state'), ('encoding.py', 'encoded')),
+    'ai_move': (('game.py', 'play'), ('game.py', 'found')),
+}
+
+
+def focus_of(filename, function):
+    """
+    :return: names of FOCUS entries the function belongs to
+    """
+    location = (os.path.basename(filename), function)
+    return [name for name, functions in FOCUS.items() if location in functions]
+
+
+class SamplingProfile(object):
+    mode = 'sample'
+    extension = 'collapsed'
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.__interval = interval
+        self.__stacks = {}
+        self.__previous_handler = None
+
+    def start(self):
+        self.__previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.__interval, self.__interval)
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_name))
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        self.__stacks[stack] = self.__stacks.get(stack, 0) + 1
+
+    def stop(self, path):
+        """
+        :param path: collapsed stacks file
+        :return: summary
+        """
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.__previous_handler or signal.SIG_DFL)
+        total = sum(self.__stacks.values())
+        focus = dict((name, 0) for name in FOCUS)
+        with open(path, 'w') as fp:
+            for stack, samples in self.__stacks.iteritems():
+                fp.write('%s %s\n' % (';'.join('%s:%s' % (os.path.basename(filename), function)
+                                                for filename, function in stack), samples))
+                for name in set(name for filename, function in stack for name in focus_of(filename, function)):
+                    focus[name] += samples
+        return {'samples': total,
+                'focus': dict((name, samples / float(total or 1)) for name, samples in focus.items())}
+
+
+class CProfile(object):
+    mode = 'cprofile'
+    extension = 'pstats'
+
+    def __init__(self):
+        self.__profile = cProfile.Profile()
+        self.__started = None
+
+    def start(self):
+        self.__started = time.time()
+        self.__profile.enable()
+
+    def stop(self, path):
+        """
+        :param path: pstats file
+        :return: summary, focus is cumulative time of the path as share of the window
+        """
+        self.__profile.disable()
+        elapsed = time.time() - self.__started
+        self.__profile.dump_stats(path)
+        focus = dict((name, 0.0) for name in FOCUS)
+        for (filename, line, function), stat in pstats.Stats(path).stats.items():
+            for name in focus_of(filename, function):
+                focus[name] = max(focus[name], stat[3])
+        return {'seconds': elapsed, 'focus': dict((name, spent / elapsed) for name, spent in focus.items())}
+
+
+PROFILES = dict((profile.mode, profile) for profile in (SamplingProfile, CProfile))
+
+
+class Profiler(object):
+    """
+    Runs one profiling window at a time
+    """
+
+    def __init__(self, directory=settings.PROFILE_DIR):
+        self.__directory = directory
+        self.__profile = None
+        self.__path = None
+        self.__timer = None
+        self.last = None
+
+    @property
+    def active(self):
+        return self.__profile is not None
+
+    def status(self):
+        return {'active': self.active, 'file': self.__path, 'last': self.last}
+
+    def start(self, mode='sample', seconds=settings.PROFILE_SECONDS):
+        """starts profiling window, it's stopped after seconds
+
+        :param mode: one of PROFILES
+        :param seconds: up to MAX_SECONDS
+        :return: file profile will be written to or False if other window is active
+        """
+        if self.active:
+            return False
+        if not os.path.isdir(self.__directory):
+            os.makedirs(self.__directory)
+        profile = PROFILES[mode]()
+        self.__path = os.path.join(self.__directory, '%s-%s-%s.%s' % (
+            mode, os.getpid(), time.strftime('%Y%m%d-%H%M%S'), profile.extension))
+        self.__profile = profile
+        self.__timer = reactor.callLater(min(seconds, MAX_SECONDS), self.stop)
+        profile.start()
+        log.msg('Profiling (%s) for %s seconds' % (mode, seconds))
+        return self.__path
+
+    def stop(self):
+        """stops active window and writes its result
+
+        :return: summary of the window or None if there was no window
+        """
+        if not self.active:
+            return None
+        if self.__timer.active():
+            self.__timer.cancel()
+        profile, self.__profile = self.__profile, None
+        summary = profile.stop(self.__path)
+        summary.update(mode=profile.mode, file=self.__path)
+        self.last = summary
+        self.__path = self.__timer = None
+        log.msg('Profile written to %s, time share: %s' % (summary['file'], ', '.join(
+            '%s %.1f%%' % (name, share * 100) for name, share in sorted(summary['focus'].items()))))
+        return summary
+
+    def toggle(self):
+        """starts default window or stops active one early"""
+        if self.active:
+            self.stop()
+        else:
+            self.start()
+
+
+profiler = Profiler()
+
+
+def install_signal():
+    """SIGUSR1 toggles sampling window of PROFILE_SECONDS
+
+    :return:
+    """
+    signal.signal(signal.SIGUSR1, lambda signum, frame: reactor.callFromThread(profiler.toggle))
@@ -1,6 +1,69 @@
+# user store: 'file' - append-only data file and sorted index of it (store.py), 'sqlite' - SQLite database in WAL
+# mode (sqlstore.py). `python migrate.py` copies users between them
+STORE = 'file'
+STORE_FILE = 'users.store'
+STORE_INDEX_FILE = 'users.index'
+SQLITE_FILE = 'users.sqlite'
+# records written since the last compaction (SQLite checkpoint) which trigger the next one, on start file store
+# replays all of them
+STORE_COMPACT_EVERY = 20000
+# offline users kept in memory after they were used, online ones are always kept
+USER_CACHE_SIZE = 10000
+# pickle snapshot and journal of older versions, imported into store on the first start
 DB_FILE = 'users.pickle'
+JOURNAL_FILE = 'users.journal'
+COMMIT_WINDOW = 0.2
+COMMIT_MAX_BACKLOG = 5000
+# failed batch of users is retried after delay doubled with every failure, up to this many seconds
+COMMIT_MAX_RETRY_DELAY = 30
+# failures in a row after which flush on shutdown gives up and unsaved changes are lost
+COMMIT_FLUSH_RETRIES = 5
+PORT = 8899
+# longest command line accepted from client, bytes
+MAX_LINE_LENGTH = 1024
+WORKERS = 1
+# admin HTTP endpoint, listens on 127.0.0.1 only. With several workers coordinator takes ADMIN_PORT
+# and worker N takes ADMIN_PORT + 1 + N. 0 disables it
+ADMIN_PORT = 8900
+# collect metrics exposed by admin endpoint
+METRICS = True
+# profiles started from admin endpoint or by SIGUSR1 are written there, SIGUSR1 profiles for PROFILE_SECONDS
+PROFILE_DIR = 'profiles'
+PROFILE_SECONDS = 30
+# shared secret for starting and stopping profiles from admin endpoint (X-Admin-Token header),
+# POST /profile is refused while it's not set
+ADMIN_TOKEN = None
+COORDINATOR_SOCKET = 'coordinator.sock'
 WAIT_TIMEOUT = 10
 GAME_TIMEOUT = 60
+# silent authorized clients are pinged every HEARTBEAT_INTERVAL seconds and dropped after HEARTBEAT_MISSES pings
+HEARTBEAT_INTERVAL = 3
+HEARTBEAT_MISSES = 3
+# seconds to authorize after connecting
+AUTH_TIMEOUT = 10
+# queued players are matched again every MATCH_TICK seconds, so their rating windows can widen
+MATCH_TICK = 1
+
+# Elo rating of new players and points at stake in one game
+RATING_START = 1500
+RATING_K = 32
+# players are indexed by rating buckets of RATING_BUCKET points. Player accepts partners from own bucket and
+# one more bucket on each side for every RATING_WIDEN_EVERY seconds in queue, up to RATING_MAX_WINDOW buckets
+RATING_BUCKET = 100
+RATING_WIDEN_EVERY = 2
+RATING_MAX_WINDOW = 5
+
+AI_LEVELS = {'easy': 1, 'medium': 3, 'hard': 9}
+AI_LEVEL = 'hard'
+AI_MOVE_TIME = 0.5
+AI_TABLE_SIZE = 100000
+# processes searching AI moves, 0 searches in reactor thread
+AI_PROCESSES = 2
+POSITION_TABLE = 'positions.bin'
+
+BOARD_SIZE = 3
+MIN_BOARD_SIZE = 3
+MAX_BOARD_SIZE = 19
 
 CIRCLE = 'o'
 CROSS = 'x'
\ No newline at end of file
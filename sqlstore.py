@@ -0,0 +1,114 @@
+"""
+SQLite user store in WAL mode: users are rows indexed by user_id, auth reads single row while worker thread
+writes changed users through its own connection.
+
+Every GroupCommitter batch is one transaction: both players of a game are saved in the same reactor turn, so
+their stats are committed together, and batch carries all games ended during COMMIT_WINDOW. Statements are
+constant strings, sqlite3 module keeps them prepared in statement cache of each connection
+"""
+import sqlite3
+
+import settings
+
+SCHEMA = ('CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, name TEXT NOT NULL, wins INTEGER NOT NULL, '
+          'loses INTEGER NOT NULL, ties INTEGER NOT NULL, rating REAL NOT NULL) WITHOUT ROWID')
+SELECT_USER = 'SELECT user_id, name, wins, loses, ties, rating FROM users WHERE user_id = ?'
+SELECT_USERS = 'SELECT user_id, name, wins, loses, ties, rating FROM users'
+SAVE_USER = 'INSERT OR REPLACE INTO users (user_id, name, wins, loses, ties, rating) VALUES (?, ?, ?, ?, ?, ?)'
+
+
+class SQLiteStore(object):
+    name = 'sqlite'
+
+    def __init__(self, from_row, db_file=settings.SQLITE_FILE):
+        """
+        :param from_row: makes user of (user_id, name, wins, loses, ties, rating) row, see user.User.from_row
+        :param db_file:
+        """
+        self.__from_row = from_row
+        self.__db_file = db_file
+        self.__reader = None
+        self.__writer = None
+        self.__records = 0
+
+    @property
+    def records(self):
+        """number of records written since last checkpoint
+
+        :return:
+        """
+        return self.__records
+
+    @property
+    def empty(self):
+        return self.__reader.execute('SELECT 1 FROM users LIMIT 1').fetchone() is None
+
+    def connect(self, **kwargs):
+        connection = sqlite3.connect(self.__db_file, **kwargs)
+        connection.text_factory = str
+        return connection
+
+    def open(self):
+        """Creates database if needed. Transactions aren't synced to disk, only checkpoints are: committed batch
+        survives crash of the process, like appended record of FileStore
+
+        :return:
+        """
+        # writer is used by one thread of reactor thread pool at a time
+        self.__writer = self.connect(check_same_thread=False)
+        self.__writer.execute('PRAGMA journal_mode = WAL')
+        self.__writer.execute('PRAGMA synchronous = NORMAL')
+        self.__writer.execute(SCHEMA)
+        self.__writer.commit()
+        self.__reader = self.connect()
+
+    def close(self):
+        for connection in (self.__reader, self.__writer):
+            if connection is not None:
+                connection.close()
+        self.__reader = self.__writer = None
+
+    def get(self, user_id):
+        """
+        :param user_id:
+        :return: user or None
+        """
+        row = self.__reader.execute(SELECT_USER, (user_id,)).fetchone()
+        if row is None:
+            return None
+        return self.__from_row(row)
+
+    @staticmethod
+    def encode(user_id, changed):
+        """
+        :param user_id:
+        :param changed:
+        :type changed: user.User
+        :return: record for append_many
+        """
+        return changed.row
+
+    def append_many(self, records):
+        """Writes records in one transaction
+
+        :param records:
+        :return:
+        """
+        with self.__writer:
+            self.__writer.executemany(SAVE_USER, records)
+        self.__records += len(records)
+
+    def compact(self):
+        """Moves write-ahead log into database file
+
+        :return:
+        """
+        self.__writer.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.__records = 0
+
+    def items(self):
+        """
+        :return: iterator of all (user_id, user) pairs
+        """
+        for row in self.__reader.execute(SELECT_USERS):
+            yield row[0], self.__from_row(row)
@@ -0,0 +1,323 @@
+"""
+Keyed on-disk user stores, users are read one by one when they log in instead of being loaded all at start.
+Store is selected by STORE setting, every store has the same methods: open, close, empty, get, encode,
+append_many (called from worker thread by GroupCommitter with records made by encode), records, compact and
+items. See FileStore below and sqlstore.SQLiteStore
+
+FileStore data file is append-only log of user records (the same records as in Journal). Index file is sorted array of
+(user_id, offset, length) entries covering data file up to some offset. Index is memory-mapped and searched by
+bisection, only records appended after it was written are replayed on open, so start takes the same time for
+any number of users.
+
+Compaction merges those records into new index. Once stale records take more than half of data file, live
+records are copied into data file of the next generation. New index is renamed over the old one only after its
+data file is on disk, so crash at any point leaves consistent pair of files
+"""
+import glob
+import mmap
+import os
+import threading
+from itertools import islice
+from pickle import loads
+from struct import Struct
+from zlib import crc32
+
+import settings
+from journal import RECORD_HEADER, Journal
+
+INDEX_MAGIC = b'TTTI'
+INDEX_HEADER = Struct('>4sIQIQ')  # magic, data file generation, data covered by index, entries, live data bytes
+ENTRY = Struct('>32sQI')  # user_id, record offset, record length
+KEY_SIZE = 32
+# data files smaller than that aren't rewritten however many stale records they have
+MIN_VACUUM_SIZE = 1 << 20
+COPY_BATCH = 10000
+
+
+class FileStore(object):
+    """
+    Reads are done on reactor thread, appends and compaction on worker thread, one at a time
+    """
+    name = 'file'
+
+    def __init__(self, data_file=settings.STORE_FILE, index_file=settings.STORE_INDEX_FILE):
+        """
+        :param data_file: data files are named by it with generation suffix
+        :param index_file:
+        """
+        self.__data_file = data_file
+        self.__index_file = index_file
+        self.__lock = threading.RLock()
+        self.__generation = 0
+        self.__index = None
+        self.__count = 0
+        self.__recent = {}
+        self.__size = 0
+        self.__live = 0
+        self.__records = 0
+        self.__reader = None
+        self.__writer = None
+
+    @property
+    def records(self):
+        """number of records appended since last compaction
+
+        :return:
+        """
+        return self.__records
+
+    @property
+    def empty(self):
+        return not self.__count and not self.__recent
+
+    def data_path(self, generation=None):
+        return '%s.%d' % (self.__data_file, self.__generation if generation is None else generation)
+
+    def open(self):
+        """Maps index and replays records appended after it. Data files of other generations (previous one after
+        compaction or one left by interrupted compaction) are removed, as well as torn record at the end of data file
+
+        :return:
+        """
+        covered = 0
+        if os.path.exists(self.__index_file):
+            with open(self.__index_file, 'rb') as fp:
+                self.__index = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.__generation, covered, self.__count, self.__live = INDEX_HEADER.unpack_from(self.__index)
+            if magic != INDEX_MAGIC:
+                raise ValueError('%s is not user index' % self.__index_file)
+        for path in glob.glob(self.__data_file + '.*'):
+            if path != self.data_path() and path.rsplit('.', 1)[1].isdigit():
+                os.remove(path)
+        path = self.data_path()
+        self.__reader = open(path, 'a+b')
+        self.__reader.seek(covered)
+        self.__size = covered
+        for user_id, user in Journal.read_records(self.__reader):
+            end = self.__reader.tell()
+            self.remember(user_id, self.__size, end - self.__size)
+            self.__size = end
+            self.__records += 1
+        if self.__size != os.path.getsize(path):
+            self.__reader.truncate(self.__size)
+        self.__writer = open(path, 'ab')
+
+    def close(self):
+        for fp in (self.__reader, self.__writer, self.__index):
+            if fp is not None:
+                fp.close()
+        self.__reader = self.__writer = self.__index = None
+
+    @staticmethod
+    def key(user_id):
+        """
+        :return: user_id as index key or None if it can't be one
+        """
+        try:
+            user_id = str(user_id)
+        except UnicodeError:
+            return None
+        if len(user_id) > KEY_SIZE:
+            return None
+        return user_id.ljust(KEY_SIZE, b'\0')
+
+    def search(self, key):
+        """
+        :param key:
+        :return: number of index entry with key or of the first one after it, True if key was found
+        """
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            position = INDEX_HEADER.size + middle * ENTRY.size
+            current = self.__index[position:position + KEY_SIZE]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return middle, True
+        return low, False
+
+    def locate(self, user_id):
+        """
+        :param user_id:
+        :return: (offset, length) of the latest record of user or None
+        """
+        found = self.__recent.get(user_id)
+        if found is not None or not self.__count:
+            return found
+        key = self.key(user_id)
+        if key is None:
+            return None
+        number, found = self.search(key)
+        if not found:
+            return None
+        return ENTRY.unpack_from(self.__index, INDEX_HEADER.size + number * ENTRY.size)[1:]
+
+    def remember(self, user_id, offset, length):
+        previous = self.locate(user_id)
+        if previous is not None:
+            self.__live -= previous[1]
+        self.__live += length
+        self.__recent[user_id] = (offset, length)
+
+    def read(self, offset, length):
+        """
+        :return: record at offset. Compaction in worker thread reopens reader, so it is used under lock
+        """
+        with self.__lock:
+            self.__reader.seek(offset)
+            return self.__reader.read(length)
+
+    @staticmethod
+    def decode(record, offset):
+        """
+        :param record:
+        :param offset: offset of record, for error message
+        :return: (user_id, user)
+        """
+        if len(record) >= RECORD_HEADER.size:
+            length, checksum = RECORD_HEADER.unpack_from(record)
+            payload = record[RECORD_HEADER.size:]
+            if len(payload) == length and crc32(payload) & 0xffffffff == checksum:
+                return loads(payload)
+        raise ValueError('broken user record at offset %s' % offset)
+
+    def get(self, user_id):
+        """
+        :param user_id:
+        :return: user or None
+        """
+        with self.__lock:
+            found = self.locate(user_id)
+            if found is None:
+                return None
+            offset, length = found
+            record = self.read(offset, length)
+        return self.decode(record, offset)[1]
+
+    @staticmethod
+    def encode(user_id, user):
+        """
+        :param user_id:
+        :param user:
+        :return: record for append_many
+        """
+        if FileStore.key(user_id) is None:
+            raise ValueError('user_id %r is longer than %s bytes' % (user_id, KEY_SIZE))
+        return user_id, Journal.encode(user_id, user)
+
+    def append_many(self, records):
+        """Appends encoded records with single write, users can be read once it's done
+
+        :param records:
+        :return:
+        """
+        self.__writer.write(b''.join(record for user_id, record in records))
+        self.__writer.flush()
+        with self.__lock:
+            for user_id, record in records:
+                self.remember(user_id, self.__size, len(record))
+                self.__size += len(record)
+            self.__records += len(records)
+
+    def entries(self, first, last):
+        """
+        :return: raw index entries from first to last (not included)
+        """
+        if self.__index is None:
+            return b''
+        return self.__index[INDEX_HEADER.size + first * ENTRY.size:INDEX_HEADER.size + last * ENTRY.size]
+
+    def merged_entries(self):
+        """index entries with records appended after index. Unchanged entries are copied in chunks between
+        changed users, so cost mostly depends on number of changed users
+
+        :return: raw entries
+        """
+        chunks = []
+        copied = 0
+        for user_id in sorted(self.__recent):
+            key = self.key(user_id)
+            number, found = self.search(key)
+            chunks.append(self.entries(copied, number))
+            chunks.append(ENTRY.pack(key, *self.__recent[user_id]))
+            copied = number + 1 if found else number
+        chunks.append(self.entries(copied, self.__count))
+        return b''.join(chunks)
+
+    def vacuum(self, entries, generation):
+        """copies live records into data file of generation
+
+        :param entries: raw index entries
+        :param generation:
+        :return: entries pointing into new data file
+        """
+        moved = []
+        offset = 0
+        # own reader, the shared one is used by reactor thread meanwhile
+        with open(self.data_path(), 'rb') as source, open(self.data_path(generation), 'wb') as fp:
+            for position in range(0, len(entries), ENTRY.size):
+                key, old_offset, length = ENTRY.unpack_from(entries, position)
+                source.seek(old_offset)
+                fp.write(source.read(length))
+                moved.append(ENTRY.pack(key, offset, length))
+                offset += length
+            fp.flush()
+            os.fsync(fp.fileno())
+        return b''.join(moved)
+
+    def compact(self):
+        """Writes index covering all records, copies live records into new data file if there are too many
+        stale ones
+
+        :return:
+        """
+        entries = self.merged_entries()
+        generation, size = self.__generation, self.__size
+        if self.__size > MIN_VACUUM_SIZE and self.__live * 2 < self.__size:
+            generation += 1
+            entries = self.vacuum(entries, generation)
+            size = self.__live
+        tmp_file = self.__index_file + '.tmp'
+        with open(tmp_file, 'wb') as fp:
+            fp.write(INDEX_HEADER.pack(INDEX_MAGIC, generation, size, len(entries) // ENTRY.size, self.__live))
+            fp.write(entries)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_file, self.__index_file)
+        with self.__lock:
+            self.close()
+            self.__recent = {}
+            self.__records = 0
+            self.open()
+
+    def items(self):
+        """
+        :return: iterator of all (user_id, user) pairs
+        """
+        entries = self.merged_entries()
+        for position in range(0, len(entries), ENTRY.size):
+            key, offset, length = ENTRY.unpack_from(entries, position)
+            yield self.decode(self.read(offset, length), offset)
+
+
+def copy_users(users, target, batch=COPY_BATCH):
+    """copies users into store and compacts it
+
+    :param users: iterable of (user_id, user) pairs
+    :param target: opened store
+    :param batch: users appended at once
+    :return: number of users copied
+    """
+    users = iter(users)
+    copied = 0
+    while True:
+        chunk = list(islice(users, batch))
+        if not chunk:
+            break
+        target.append_many([target.encode(user_id, user) for user_id, user in chunk])
+        copied += len(chunk)
+    target.compact()
+    return copied
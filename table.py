@@ -0,0 +1,246 @@
+"""
+Precomputed table of all 3x3 positions: outcome and best move for each side.
+
+Position index is ternary number, digit of cell is 0 for empty, 1 for cross, 2 for circle. Every position takes
+two bytes: outcome and best moves (cross move in high nibble, circle move in low one, NO_MOVE if there is none).
+Table is memory-mapped read-only, so all processes share single copy of it.
+
+Regenerate with `python table.py build`, check with `python table.py verify`
+"""
+import mmap
+import os
+from argparse import ArgumentParser
+
+import settings
+from engine import WIN, Engine
+
+MAGIC = b'TTTPOS01'
+SIZE = 3
+CELLS = SIZE * SIZE
+POSITIONS = 3 ** CELLS
+NO_MOVE = 0xf
+
+GAME = 0
+CROSS_WIN = 1
+CIRCLE_WIN = 2
+TIE = 3
+INVALID = 4
+
+# ternary digits of every 9 bit mask, index of position is TERNARY[cross] + 2 * TERNARY[circle]
+TERNARY = tuple(sum(3 ** cell for cell in range(CELLS) if mask >> cell & 1) for mask in range(1 << CELLS))
+# lines are listed here independently from game.Rules, so table can be verified against it
+LINES = tuple([sum(1 << (y * SIZE + x) for x in range(SIZE)) for y in range(SIZE)] +
+              [sum(1 << (y * SIZE + x) for y in range(SIZE)) for x in range(SIZE)] +
+              [sum(1 << (i * SIZE + i) for i in range(SIZE)), sum(1 << (i * SIZE + SIZE - 1 - i) for i in range(SIZE))])
+FULL = (1 << CELLS) - 1
+
+
+def masks_of(index):
+    cross, circle = 0, 0
+    for cell in range(CELLS):
+        index, digit = divmod(index, 3)
+        if digit == 1:
+            cross |= 1 << cell
+        elif digit == 2:
+            circle |= 1 << cell
+    return cross, circle
+
+
+def has_line(mask):
+    for line in LINES:
+        if mask & line == line:
+            return True
+    return False
+
+
+def outcome_of(cross, circle):
+    cross_won, circle_won = has_line(cross), has_line(circle)
+    if cross_won and circle_won:
+        return INVALID
+    if cross_won:
+        return CROSS_WIN
+    if circle_won:
+        return CIRCLE_WIN
+    if cross | circle == FULL:
+        return TIE
+    return GAME
+
+
+class Solver(object):
+    """
+    Perfect play for every position and side to move, memoized
+    """
+    def __init__(self):
+        self.__memo = {}
+
+    def solve(self, own, other):
+        """value of position which is not finished yet
+
+        :param own: mask of player to move
+        :param other: mask of his opponent
+        :return: (value for player to move: 1 win, 0 tie, -1 lose, best move or NO_MOVE)
+        """
+        key = (own, other)
+        if key in self.__memo:
+            return self.__memo[key]
+        best, best_move = -2, NO_MOVE
+        for cell in range(CELLS):
+            if (own | other) >> cell & 1:
+                continue
+            placed = own | (1 << cell)
+            if has_line(placed):
+                value = 1
+            elif placed | other == FULL:
+                value = 0
+            else:
+                value = -self.solve(other, placed)[0]
+            if value > best:
+                best, best_move = value, cell
+            if best == 1:
+                break
+        self.__memo[key] = (best, best_move)
+        return best, best_move
+
+
+def build_bytes():
+    """
+    :return: whole table file content
+    """
+    solver = Solver()
+    data = bytearray(MAGIC)
+    for index in range(POSITIONS):
+        cross, circle = masks_of(index)
+        outcome = outcome_of(cross, circle)
+        moves = (NO_MOVE << 4) | NO_MOVE
+        if outcome == GAME:
+            moves = (solver.solve(cross, circle)[1] << 4) | solver.solve(circle, cross)[1]
+        data.append(outcome)
+        data.append(moves)
+    return bytes(data)
+
+
+def build(path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(build_bytes())
+    os.rename(tmp_path, path)
+
+
+class PositionTable(object):
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self.__map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.__map[:len(MAGIC)] != MAGIC or len(self.__map) != len(MAGIC) + 2 * POSITIONS:
+            self.__map.close()
+            raise ValueError('%s is not a position table' % path)
+
+    @staticmethod
+    def index(cross, circle):
+        return TERNARY[cross] + 2 * TERNARY[circle]
+
+    def outcome(self, cross, circle):
+        """
+        :param cross: mask of cross signs
+        :param circle: mask of circle signs
+        :return: one of GAME, CROSS_WIN, CIRCLE_WIN, TIE, INVALID
+        """
+        return ord(self.__map[len(MAGIC) + 2 * self.index(cross, circle)])
+
+    def best_move(self, cross, circle, sign):
+        """perfect move for sign, (x, y) or None if game is over
+
+        :param cross:
+        :param circle:
+        :param sign:
+        :return:
+        """
+        moves = ord(self.__map[len(MAGIC) + 2 * self.index(cross, circle) + 1])
+        cell = moves >> 4 if sign == settings.CROSS else moves & 0xf
+        if cell == NO_MOVE:
+            return None
+        return cell % SIZE, cell // SIZE
+
+    def close(self):
+        self.__map.close()
+
+
+position_table = None
+
+
+def load(path=settings.POSITION_TABLE):
+    """memory-maps position table, building it first if there is no such file
+
+    :param path:
+    :return:
+    :rtype: PositionTable
+    """
+    global position_table
+    if not os.path.exists(path):
+        build(path)
+    position_table = PositionTable(path)
+    return position_table
+
+
+def verify(path):
+    """compares table with freshly built one, outcomes with Rules and best moves with Engine
+
+    :param path:
+    :return: list of problems
+    """
+    from game import NOBODY, O, X, Field, Rules
+
+    problems = []
+    with open(path, 'rb') as fp:
+        if fp.read() != build_bytes():
+            problems.append('table differs from freshly built one')
+    table = PositionTable(path)
+    engine = Engine(SIZE, SIZE, Rules.windows_through_cells(SIZE, SIZE))
+    rules = Rules()
+    for index in range(POSITIONS):
+        cross, circle = masks_of(index)
+        outcome = table.outcome(cross, circle)
+        field = Field(SIZE)
+        for cell in range(CELLS):
+            if cross >> cell & 1:
+                field.put_cross(cell % SIZE, cell // SIZE)
+            elif circle >> cell & 1:
+                field.put_circle(cell % SIZE, cell // SIZE)
+        won = set(sign for cell in range(CELLS) for sign in [field.cell(cell % SIZE, cell // SIZE)]
+                  if sign != NOBODY and rules.check_win_from_move(field, cell % SIZE, cell // SIZE))
+        expected = {frozenset(): TIE if field.is_full else GAME, frozenset([X]): CROSS_WIN,
+                    frozenset([O]): CIRCLE_WIN}.get(frozenset(won), INVALID)
+        if outcome != expected:
+            problems.append('position %s: outcome %s, rules say %s' % (index, outcome, expected))
+        if outcome != GAME:
+            continue
+        for sign, own, other in ((settings.CROSS, cross, circle), (settings.CIRCLE, circle, cross)):
+            x, y = table.best_move(cross, circle, sign)
+            cell = y * SIZE + x
+            if (cross | circle) >> cell & 1:
+                problems.append('position %s: illegal move %s for %s' % (index, cell, sign))
+                continue
+            best = engine.search(own, other, CELLS, -2 * WIN, 2 * WIN)[0]
+            placed = own | (1 << cell)
+            if engine.is_win(placed, cell):
+                value = WIN
+            else:
+                value = -engine.search(other, placed, CELLS, -2 * WIN, 2 * WIN)[0]
+            if (value > 0) - (value < 0) != (best > 0) - (best < 0):
+                problems.append('position %s: move %s for %s is not the best one' % (index, cell, sign))
+    table.close()
+    return problems
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='3x3 position table tool')
+    parser.add_argument('action', choices=['build', 'verify'])
+    parser.add_argument('--path', default=settings.POSITION_TABLE)
+    args = parser.parse_args()
+    if args.action == 'build':
+        build(args.path)
+        print('Built %s' % args.path)
+    else:
+        found = verify(args.path)
+        for problem in found:
+            print(problem)
+        print('%s problems found' % len(found))
@@ -0,0 +1,108 @@
+from math import ceil
+
+from twisted.internet import reactor, task
+from twisted.python import log
+
+
+class TimerWheel(object):
+    """
+    Coarse timers for many keys (connections, matchmaking queues), one tick per second.
+
+    Timer only remembers its deadline, so resetting it is a dict update. Keys sit in wheel slot of the tick
+    their deadline was due when they were put there; sweep of a slot fires timers which are due and moves the rest
+    to slots of their new deadlines. Wheel ticks only while it has timers
+    """
+
+    def __init__(self, clock=None, tick=1.0, slots=64):
+        """
+        :param clock: reactor by default
+        :param tick: seconds, timers fire up to one tick late
+        :param slots: timers longer than slots * tick just stay in wheel for several turns
+        """
+        self.__clock = clock or reactor
+        self.__tick = tick
+        self.__slots = [set() for _ in range(slots)]
+        self.__deadlines = {}
+        self.__placed = {}
+        self.__now_tick = 0
+        self.__started = None
+        self.__loop = None
+
+    def __contains__(self, key):
+        return key in self.__deadlines
+
+    def __len__(self):
+        return len(self.__deadlines)
+
+    def schedule(self, key, delay, callback):
+        """Sets or resets timer of the key
+
+        :param key: any hashable
+        :param delay: seconds
+        :param callback: called without arguments
+        :return:
+        """
+        if self.__loop is None:
+            self.__started = self.__clock.seconds()
+            self.__now_tick = 0
+            self.__loop = task.LoopingCall.withCount(self.advance)
+            self.__loop.clock = self.__clock
+            self.__loop.start(self.__tick, now=False)
+        deadline = self.__clock.seconds() + delay
+        self.__deadlines[key] = (deadline, callback)
+        target = self.tick_of(deadline)
+        if self.__placed.get(key, target + 1) > target:
+            self.place(key, target)
+
+    def cancel(self, key):
+        """
+        :param key:
+        :return: True if key had timer
+        """
+        if self.__deadlines.pop(key, None) is None:
+            return False
+        self.__slots[self.__placed.pop(key) % len(self.__slots)].discard(key)
+        return True
+
+    def tick_of(self, deadline):
+        return max(self.__now_tick + 1, int(ceil((deadline - self.__started) / self.__tick)))
+
+    def place(self, key, target):
+        if key in self.__placed:
+            self.__slots[self.__placed[key] % len(self.__slots)].discard(key)
+        self.__placed[key] = target
+        self.__slots[target % len(self.__slots)].add(key)
+
+    def advance(self, ticks):
+        """sweeps slots of all ticks passed since the previous call
+
+        :param ticks: ticks passed, more than one if reactor was busy
+        :return:
+        """
+        for _ in range(ticks):
+            self.__now_tick += 1
+            self.sweep(self.__now_tick)
+        if not self.__deadlines and self.__loop is not None:
+            self.__loop.stop()
+            self.__loop = None
+
+    def sweep(self, tick):
+        now = self.__clock.seconds()
+        slot = self.__slots[tick % len(self.__slots)]
+        for key in [key for key in slot if self.__placed[key] <= tick]:
+            entry = self.__deadlines.get(key)
+            if entry is None:
+                # cancelled by callback of other timer in this slot
+                continue
+            deadline, callback = entry
+            if deadline > now:
+                self.place(key, self.tick_of(deadline))
+                continue
+            self.cancel(key)
+            try:
+                callback()
+            except Exception:
+                log.err(None, 'Timer of %r failed' % (key,))
+
+
+wheel = TimerWheel()
@@ -1,12 +1,44 @@
+import os
 import uuid
+from collections import OrderedDict
+from functools import partial
 from random import randint
 
-import os
+from twisted.python import log
 
+import metrics
 import settings
-from pickle import dump, load
+from encoding import encode
+from journal import Journal
+from persistence import GroupCommitter
+from sqlstore import SQLiteStore
+from store import FileStore, copy_users
+
+def elo(rating, other, score, k=settings.RATING_K):
+    """
+    :param rating: rating of player
+    :param other: rating of opponent
+    :param score: 1 for win, 0.5 for tie, 0 for lose
+    :param k: points at stake
+    :return: new rating of player
+    """
+    expected = 1 / (1 + 10 ** ((other - rating) / 400.0))
+    return rating + k * (score - expected)
+
+
+NAME_FORMAT = 'User-%s'
+
 
 class User(object):
+    """
+    Fields are kept in slots, display name is kept as its number. Pickled state is the same dict users had before
+    slots, so pickles of older and newer versions are readable by both.
+
+    Stats and player header of game state are cached until counters or rating change
+    """
+    __slots__ = ('__wins', '__loses', '__ties', '__rating', '__id', '__number', '__stats', '__header',
+                 '__header_encoded')
+
     def __init__(self, user_id):
         """As we're using pickle -> we can store all the data in classes and access it directly
 
@@ -16,8 +48,70 @@ class User(object):
         self.wins = 0
         self.loses = 0
         self.ties = 0
+        self.rating = settings.RATING_START
         self.__id = user_id
-        self.__name = 'User-%s' % randint(1,100000) # we can have same names, but I'm not particularly concerned right now
+        self.__number = randint(1,100000) # we can have same names, but I'm not particularly concerned right now
+
+    def __getstate__(self):
+        return {'wins': self.wins, 'loses': self.loses, 'ties': self.ties, 'rating': self.rating,
+                '_User__id': self.__id, '_User__name': self.name}
+
+    def __setstate__(self, state):
+        """
+        :param state: users pickled before ratings were introduced start with default one
+        :return:
+        """
+        self.wins, self.loses, self.ties = state['wins'], state['loses'], state['ties']
+        self.rating = state.get('rating', settings.RATING_START)
+        self.__id = state['_User__id']
+        self.__number = self.name_number(state['_User__name'])
+
+    @staticmethod
+    def name_number(name):
+        return int(name[len(NAME_FORMAT % ''):])
+
+    def invalidate(self):
+        """drops cached stats and header, they are built again when needed
+
+        :return:
+        """
+        self.__stats = self.__header = self.__header_encoded = None
+
+    @property
+    def wins(self):
+        return self.__wins
+
+    @wins.setter
+    def wins(self, value):
+        self.__wins = value
+        self.invalidate()
+
+    @property
+    def loses(self):
+        return self.__loses
+
+    @loses.setter
+    def loses(self, value):
+        self.__loses = value
+        self.invalidate()
+
+    @property
+    def ties(self):
+        return self.__ties
+
+    @ties.setter
+    def ties(self, value):
+        self.__ties = value
+        self.invalidate()
+
+    @property
+    def rating(self):
+        return self.__rating
+
+    @rating.setter
+    def rating(self, value):
+        self.__rating = value
+        self.invalidate()
 
     @property
     def protocol(self):
@@ -33,21 +127,61 @@ class User(object):
 
         :return:
         """
-        win_ratio = 0
-        lose_ratio = 0
-        tie_ratio = 0
-        total = float(self.wins + self.loses + self.ties)
-        if self.wins != 0:
-            win_ratio = self.wins / total
-        if self.loses != 0:
-            lose_ratio = self.loses / total
-        if self.ties != 0:
-            tie_ratio = self.ties / total
-        return win_ratio, lose_ratio, tie_ratio
+        if self.__stats is None:
+            win_ratio = 0
+            lose_ratio = 0
+            tie_ratio = 0
+            total = float(self.wins + self.loses + self.ties)
+            if self.wins != 0:
+                win_ratio = self.wins / total
+            if self.loses != 0:
+                lose_ratio = self.loses / total
+            if self.ties != 0:
+                tie_ratio = self.ties / total
+            self.__stats = win_ratio, lose_ratio, tie_ratio
+        return self.__stats
+
+    @property
+    def header(self):
+        """player info in game state, the same object is returned until stats or rating change
+
+        :return:
+        :rtype: dict
+        """
+        if self.__header is None:
+            self.__header = {"name": self.name, "stats": self.stats, "rating": int(round(self.rating))}
+        return self.__header
+
+    @property
+    def header_encoded(self):
+        """
+        :return: header encoded as JSON
+        """
+        if self.__header_encoded is None:
+            self.__header_encoded = encode(self.header)
+        return self.__header_encoded
 
     @property
     def name(self):
-        return self.__name
+        return NAME_FORMAT % self.__number
+
+    @property
+    def row(self):
+        """
+        :return: fields as database row
+        """
+        return self.__id, self.name, self.wins, self.loses, self.ties, self.rating
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        :param row: fields in order of User.row
+        :rtype: User
+        """
+        user = cls.__new__(cls)
+        user.__id, name, user.wins, user.loses, user.ties, user.rating = row
+        user.__number = cls.name_number(name)
+        return user
 
     @property
     def user_id(self):
@@ -57,81 +191,202 @@ class User(object):
         self.protocol.transport.loseConnection()
 
 
+# store factories by name, SQLite rows are made into users here so the store doesn't depend on this module
+STORES = {FileStore.name: FileStore, SQLiteStore.name: partial(SQLiteStore, User.from_row)}
+
+
+class UserCache(object):
+    """
+    Users kept in memory: pinned ones (online) are always kept, others are evicted in least recently used order
+    once there are more than capacity of them. Changed users are held by GroupCommitter until they are written,
+    so evicted user is never lost
+    """
+
+    def __init__(self, capacity):
+        self.__capacity = capacity
+        self.__pinned = {}
+        self.__recent = OrderedDict()
+
+    def __len__(self):
+        return len(self.__pinned) + len(self.__recent)
+
+    def __contains__(self, user_id):
+        return user_id in self.__pinned or user_id in self.__recent
+
+    def __getitem__(self, user_id):
+        user = self.get(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        return user
+
+    def __setitem__(self, user_id, user):
+        if user_id in self.__pinned:
+            self.__pinned[user_id] = user
+            return
+        self.__recent.pop(user_id, None)
+        self.__recent[user_id] = user
+        while len(self.__recent) > self.__capacity:
+            self.__recent.popitem(last=False)
+
+    def get(self, user_id, default=None):
+        user = self.__pinned.get(user_id)
+        if user is None:
+            user = self.__recent.pop(user_id, None)
+            if user is None:
+                return default
+            self.__recent[user_id] = user
+        return user
+
+    def is_pinned(self, user_id):
+        return user_id in self.__pinned
+
+    def pin(self, user_id):
+        user = self.__recent.pop(user_id, None)
+        if user is not None:
+            self.__pinned[user_id] = user
+
+    def unpin(self, user_id):
+        """
+        :param user_id:
+        :return: False if user wasn't pinned
+        """
+        user = self.__pinned.pop(user_id, None)
+        if user is None:
+            return False
+        self[user_id] = user
+        return True
+
+
 class UserManager(object):
     def __init__(self):
-        self.__lobby = set()
-        self.users = {}
-        self.load_users()
+        self.users = UserCache(settings.USER_CACHE_SIZE)
+        self.__store = STORES[settings.STORE]()
+        self.__committer = GroupCommitter(self.__store, settings.COMMIT_WINDOW, settings.COMMIT_MAX_BACKLOG,
+                                          settings.STORE_COMPACT_EVERY, self.pause_clients)
         self.protocols = {}
+        self.paused = False
+        # also called by pause_clients, coordinator relays backpressure to workers through it
+        self.on_pause = None
+
+    def get_user(self, user_id):
+        """Finds user in memory, among changes not written yet or reads it from store
+
+        :param user_id:
+        :return: user or None
+        :rtype: User
+        """
+        if not isinstance(user_id, basestring):
+            return None
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.__committer.pending(user_id) or self.__store.get(user_id)
+            if user is not None:
+                self.users[user.user_id] = user
+        return user
 
     def get_user_stats(self, user_id):
-        if user_id in self.users:
-            return self.users[user_id].stats
+        user = self.get_user(user_id)
+        if user:
+            return user.stats
         return False
 
     def load_users(self):
-        """Tries to load users from pickle file if it exists and non-empty
+        """Opens user store, users are read from it when they log in. On the first start users are imported
+        from pickle snapshot and journal of older versions
+
+        :return:
+        """
+        self.__store.open()
+        if self.__store.empty and (os.path.exists(settings.DB_FILE) or os.path.exists(settings.JOURNAL_FILE)):
+            copy_users(Journal(settings.DB_FILE, settings.JOURNAL_FILE).load().iteritems(), self.__store)
+
+    def save_user(self, user):
+        """Marks user as changed. It will be journaled with the next batch in worker thread
 
+        :param user:
+        :type user: User
         :return:
         """
-        if os.path.exists(settings.DB_FILE):
-            if os.path.getsize(settings.DB_FILE) > 0:
-                with open(settings.DB_FILE, 'rb') as fp:
-                    try:
-                        self.users.update(**load(fp))
-                    except ValueError:
-                        pass
-                    except IOError as e:
-                        raise
+        self.__committer.mark_dirty(user)
 
     def save_users(self):
-        """As we're using pickle instead of full-fledged DB - this mean to dump users on disk after each modification
+        """Writes all pending changes and compacts store. Used as shutdown hook
+
+        :return: deferred fired when everything is on disk or, with error logged, once writes failed
+            COMMIT_FLUSH_RETRIES times in a row
         """
-        with open(settings.DB_FILE, 'wb') as fp:
-            try:
-                dump(self.users, fp)
-            except IOError as e:
-                raise
+        flushed = metrics.time_deferred(self.__committer.flush(compact=True), 'save_users_seconds')
+        return flushed.addErrback(log.err, 'Users are not saved, giving up')
 
-    def register_new_user(self, protocol):
-        """creates new user, authorizes it and adds it to current db
+    def close(self):
+        """Closes user store, changes not saved with save_users before are lost
+
+        :return:
+        """
+        self.__store.close()
+
+    def pause_clients(self, paused):
+        """Backpressure: stop reading from clients while disk is behind
+
+        :param paused:
+        :return:
+        """
+        self.paused = paused
+        for proto in self.protocols.values():
+            if paused:
+                proto.transport.pauseProducing()
+            else:
+                proto.transport.resumeProducing()
+        if self.on_pause is not None:
+            self.on_pause(paused)
+
+    def create_user(self):
+        """creates new user and adds it to current db
 
-        :param protocol:
         :return:
+        :rtype: User
         """
         user_id = uuid.uuid1().hex
         user = User(user_id)
         self.users[user_id] = user
-        self.save_users()
-        self.auth_user(user_id, protocol)
+        self.save_user(user)
+        return user
+
+    def register_new_user(self, protocol):
+        """creates new user, authorizes it and adds it to current db
+
+        :param protocol:
+        :return:
+        """
+        user = self.create_user()
+        self.auth_user(user.user_id, protocol)
         return user
 
     def auth_user(self, user_id, proto):
-        """Adds user to lobby. If same user already logged in - disconnects older one
+        """Adds user to lobby, user stays in memory while online. If same user already logged in - disconnects
+        older one
 
         :param user_id:
         :param protocol:
         :return:
         """
-        if user_id not in self.users:
+        user = self.get_user(user_id)
+        if user is None:
             return False
-        if user_id in self.__lobby:
-            self.users[user_id].protocol.loseConnection()
+        if self.users.is_pinned(user_id):
+            user.protocol.transport.loseConnection()
         self.protocols[user_id] = proto
-        self.__lobby.add(user_id)
-        return self.users[user_id]
+        self.users.pin(user_id)
+        return user
 
 
     def remove_user(self, user_id):
-        """Removes user from lobby -> currently online users (not used now)
+        """Removes user from lobby -> currently online users, user can be evicted from memory after that
 
         :param user_id:
         :return:
         """
-        if user_id in self.__lobby:
-            self.__lobby.remove(user_id)
-            return True
-        return False
+        return self.users.unpin(user_id)
 
 try:
     user_mananger
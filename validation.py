@@ -0,0 +1,67 @@
+"""
+Validators of client commands, built once at import. Each validator takes decoded packet and returns data to use
+or False if packet is malformed. Hot `move` command is checked by hand, voluptuous is used for the rest
+"""
+from voluptuous import ALLOW_EXTRA, All, In, Invalid, Optional, Range, Schema
+
+import settings
+from framing import FRAMINGS
+
+
+def compiled(schema):
+    """
+    :param schema: voluptuous schema of the whole packet, keys not mentioned in it are allowed
+    :return: validator
+    """
+    validator = Schema(schema, required=True, extra=ALLOW_EXTRA)
+
+    def validate(packet):
+        try:
+            return validator(packet)
+        except Invalid:
+            return False
+    return validate
+
+
+def check_move(packet):
+    """
+    :param packet:
+    :return: (x, y)
+    """
+    position = packet.get('pos')
+    if type(position) is not list or len(position) != 2:
+        return False
+    x, y = position
+    if type(x) is not int or type(y) is not int:
+        return False
+    return x, y
+
+
+def accept(packet):
+    """for commands without data"""
+    return packet
+
+
+BOARD_SIZE = All(int, Range(min=settings.MIN_BOARD_SIZE, max=settings.MAX_BOARD_SIZE))
+
+VALIDATORS = {
+    'reg': compiled({Optional('delta'): bool, Optional('framing'): In(FRAMINGS)}),
+    'auth': compiled({'user_id': basestring, Optional('delta'): bool, Optional('framing'): In(FRAMINGS)}),
+    'queue': compiled({Optional('size'): BOARD_SIZE, Optional('win'): BOARD_SIZE,
+                       Optional('level'): In(settings.AI_LEVELS)}),
+    'move': check_move,
+    'state': accept,
+    'pong': accept,
+}
+
+
+def validate(command, packet):
+    """
+    :param command:
+    :param packet:
+    :return: data of valid packet or False for malformed packet or unknown command
+    """
+    validator = VALIDATORS.get(command)
+    if validator is None:
+        return False
+    return validator(packet)